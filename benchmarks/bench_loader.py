@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Get the root directory of the project with Path
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT_DIR))
+
+from utils.utils import load_util_data
+from utils.writers import get_basin_output_path, read_basin
+from utils.loader import load_basin, clear_open_maps
+from camels_spat2nh import camels_spat2nh, get_country_dir
+from synthetic_camels_spat import make_synthetic_tree
+
+N_BASINS = int(os.environ.get('BENCH_N_BASINS', 4))
+N_YEARS = int(os.environ.get('BENCH_N_YEARS', 2))
+# Random (basin, 30-day window, 2 columns) samples drawn per benchmark
+N_SAMPLES = int(os.environ.get('BENCH_N_SAMPLES', 200))
+WINDOW_DAYS = 30
+
+def read_window(file_path, output_format, columns, start, end):
+    '''
+    Read a window of a basin from its output file, as the notebooks do
+    Args:
+        file_path: str, path to the basin output file
+        output_format: str, format of the output file
+        columns: list, columns to keep
+        start: pandas.Timestamp, first day
+        end: pandas.Timestamp, last day (included)
+    Returns:
+        df: pandas.DataFrame, 'date' and the columns for the days in [start, end]
+    '''
+    df = read_basin(file_path, output_format)
+    return df[(df['date'] >= start) & (df['date'] <= end)][['date'] + columns]
+
+if __name__ == '__main__':
+
+    _, data_gen = load_util_data(str(ROOT_DIR))
+    data_gen.update({'countries': ['USA', 'CAN'], 'incremental_cache': False, 'consolidated_store': 'none',
+                     'profiling': False, 'journal': False})
+    n_sources = len(data_gen['data_sources'])
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"Writing and converting {N_BASINS} synthetic basins x {N_YEARS} years in {tmp_dir}...")
+        data_dir = make_synthetic_tree(tmp_dir, N_BASINS, N_YEARS)
+        basins = sorted(os.listdir(os.path.join(tmp_dir, 'basin_data')))
+        # One output folder per format
+        output_formats = []
+        for output_format in ['csv', 'parquet']:
+            try:
+                camels_spat2nh({**data_dir, 'data_dir_camels_spat_nh': os.path.join(tmp_dir, output_format)},
+                               {**data_gen, 'output_format': output_format}, set(), 0, 1)
+                output_formats.append(output_format)
+            except ImportError as e:
+                print(f"Skipping {output_format}: {e}")
+
+        print(f"\n{N_SAMPLES} random windows of {WINDOW_DAYS} days x 2 columns")
+        print(f"{'format':<10}{'output file (ms)':>18}{'map, first use (ms)':>21}{'map, open (ms)':>16}")
+        for output_format in output_formats:
+            data_dir_out = os.path.join(tmp_dir, output_format)
+            file_paths = {basin_f: get_basin_output_path(get_country_dir(data_dir_out, basin_f[:3], n_sources), basin_f[4:],
+                                                         output_format) for basin_f in basins}
+            dates = read_basin(file_paths[basins[0]], output_format, columns=['date'])['date']
+            columns = [col for col in read_basin(file_paths[basins[0]], output_format).columns if col != 'date']
+            samples = []
+            for _ in range(N_SAMPLES):
+                start = dates.iloc[rng.integers(len(dates) - WINDOW_DAYS)]
+                samples.append((basins[rng.integers(len(basins))], list(rng.choice(columns, 2, replace=False)),
+                                start, start + pd.Timedelta(days=WINDOW_DAYS - 1)))
+
+            times = []
+            start_time = time.perf_counter()
+            for basin_f, cols, start, end in samples:
+                read_window(file_paths[basin_f], output_format, cols, start, end)
+            times.append(time.perf_counter() - start_time)
+            # First pass builds the maps, second one reads the open maps
+            clear_open_maps()
+            for _ in range(2):
+                start_time = time.perf_counter()
+                for basin_f, cols, start, end in samples:
+                    load_basin(basin_f[:3], basin_f[4:], cols, start, end,
+                               data_dir_out=data_dir_out, n_sources=n_sources, output_format=output_format)
+                times.append(time.perf_counter() - start_time)
+            print(f"{output_format:<10}" + ''.join(f"{seconds / N_SAMPLES * 1000:>{width}.3f}"
+                                                   for seconds, width in zip(times, [18, 21, 16])))
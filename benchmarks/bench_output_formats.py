@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Get the root directory of the project with Path
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT_DIR))
+
+from utils.writers import BASIN_WRITERS, get_basin_output_path, write_basin, read_basin
+
+N_DAYS = int(os.environ.get('BENCH_N_DAYS', 15000))
+N_COLUMNS = int(os.environ.get('BENCH_N_COLUMNS', 40))
+N_REPEATS = int(os.environ.get('BENCH_N_REPEATS', 5))
+
+def make_basin_frame(n_days, n_columns, seed=0):
+    '''
+    Build a DataFrame shaped like a converted basin (daily date + float columns)
+    Args:
+        n_days: int, number of daily rows
+        n_columns: int, number of float columns
+        seed: int, random seed
+    Returns:
+        df: pandas.DataFrame, basin data with a 'date' column
+    '''
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.random((n_days, n_columns)) * 100, columns=[f'var_{i}' for i in range(n_columns)])
+    df.insert(0, 'date', pd.date_range('1980-01-01', periods=n_days, freq='D'))
+    return df
+
+def best_time(func, *args):
+    '''
+    Best wall time of N_REPEATS calls of a function
+    Args:
+        func: callable, function to time
+        args: arguments of the function
+    Returns:
+        best: float, best wall time in seconds
+    '''
+    best = np.inf
+    for _ in range(N_REPEATS):
+        start_time = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+if __name__ == '__main__':
+
+    df = make_basin_frame(N_DAYS, N_COLUMNS)
+    print(f"{N_DAYS} days x {N_COLUMNS} columns, best of {N_REPEATS}")
+    print(f"{'format':<10}{'write (s)':>12}{'size (MB)':>12}{'read (s)':>12}{'read 2 cols (s)':>18}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for output_format in BASIN_WRITERS:
+            file_path = get_basin_output_path(tmp_dir, 'basin', output_format)
+            try:
+                time_write = best_time(write_basin, df, file_path, output_format)
+            except ImportError as e:
+                print(f"{output_format:<10} skipped ({e.__class__.__name__}: missing optional dependency)")
+                continue
+            size_mb = os.path.getsize(file_path) / 1e6
+            time_read = best_time(read_basin, file_path, output_format)
+            time_read_cols = best_time(read_basin, file_path, output_format, ['var_0', 'var_1'])
+            print(f"{output_format:<10}{time_write:>12.3f}{size_mb:>12.2f}{time_read:>12.3f}{time_read_cols:>18.3f}")
@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+# Get the root directory of the project with Path
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT_DIR))
+
+from utils.writers import BASIN_WRITERS
+from utils.utils import reduceDataByDay, reduce_files_by_day, iter_forcing_files, load_util_data
+from camels_spat2nh import camels_spat2nh, processBasinSave2CSV, get_country_dir
+from synthetic_camels_spat import make_synthetic_tree
+
+N_BASINS = int(os.environ.get('BENCH_N_BASINS', 8))
+N_YEARS = int(os.environ.get('BENCH_N_YEARS', 2))
+N_REPEATS = int(os.environ.get('BENCH_N_REPEATS', 3))
+MAX_WORKERS = int(os.environ.get('BENCH_MAX_WORKERS', min(4, os.cpu_count())))
+# Seconds added to each output write, to emulate slow (network) storage
+WRITE_LATENCY = float(os.environ.get('BENCH_WRITE_LATENCY', 0))
+# Existing synthetic tree to reuse (written to a temporary folder if empty)
+DATA_DIR = os.environ.get('BENCH_DATA_DIR', '')
+
+def best_time(func, *args, setup=None):
+    '''
+    Best wall time of N_REPEATS calls of a function
+    Args:
+        func: callable, function to time
+        args: arguments of the function
+        setup: callable, untimed function called before each run (e.g. to remove previous outputs)
+    Returns:
+        best: float, best wall time in seconds
+    '''
+    best = np.inf
+    for _ in range(N_REPEATS):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start_time)
+    return best
+
+def add_write_latency(writer, latency):
+    '''
+    Slow down an output writer, as on a network file system
+    Args:
+        writer: callable, basin writer (see BASIN_WRITERS)
+        latency: float, seconds added to each write
+    Returns:
+        slow_writer: callable, writer that waits latency seconds after writing
+    '''
+    def slow_writer(df, file_path):
+        writer(df, file_path)
+        time.sleep(latency)
+    return slow_writer
+
+def reset_dir(folder):
+    '''
+    Empty a folder (created if missing)
+    Args:
+        folder: str, path to the folder
+    '''
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+
+def run_benchmarks(data_dir, data_gen):
+    '''
+    Time the daily reduction, the conversion of one basin and the full conversion (serial and parallel)
+    Args:
+        data_dir: dict, paths of the synthetic tree as in data_dir.yml
+        data_gen: dict, data from data_general.yml
+    Returns:
+        results: dict, best wall time in seconds of each benchmark
+    '''
+    basin_data_path = os.path.join(data_dir['data_dir_camels_spat'], 'basin_data')
+    data_dir_out = os.path.join(data_dir['data_dir_camels_spat_nh'], 'bench')
+    input_vars = data_gen['input_vars']
+    input_vars_repeated = set([var for var in input_vars if input_vars.count(var) > 1])
+    basin_f = sorted(os.listdir(basin_data_path))[0]
+    folder2load = os.path.join(basin_data_path, basin_f, data_dir['relative_path_forcing'])
+    results = {}
+
+    # Daily reduction of one source, in memory and streamed from the files
+    for src in ['ERA5', 'RDRS']:
+        src_files = sorted([f for f in os.listdir(folder2load) if src in f])
+        datasets = [xr.open_dataset(os.path.join(folder2load, f)) for f in src_files]
+        dataset = xr.concat(datasets, dim='time').load()
+        for ds in datasets:
+            ds.close()
+        results[f'reduceDataByDay[{src}]'] = best_time(reduceDataByDay, dataset, input_vars, data_gen['sum_vars'],
+                                                       input_vars_repeated, src.lower())
+        results[f'reduce_files_by_day[{src}]'] = best_time(
+            lambda: reduce_files_by_day(iter_forcing_files(folder2load, src_files), input_vars, data_gen['sum_vars'],
+                                        input_vars_repeated, src.lower()))
+
+    # One basin, from the forcing files to the output file
+    country_dir = get_country_dir(data_dir_out, basin_f[:3], len(data_gen['data_sources']))
+    results['processBasinSave2CSV'] = best_time(
+        processBasinSave2CSV, basin_f, basin_data_path, country_dir, data_dir['relative_path_forcing'],
+        data_dir['relative_path_target'], data_gen['data_sources'], data_gen, set(), input_vars_repeated,
+        setup=lambda: reset_dir(country_dir))
+
+    # All basins, serial and in a process pool
+    results['camels_spat2nh[serial]'] = best_time(
+        camels_spat2nh, {**data_dir, 'data_dir_camels_spat_nh': data_dir_out}, data_gen, set(), 0, 1,
+        setup=lambda: reset_dir(data_dir_out))
+    results[f'camels_spat2nh[{MAX_WORKERS} workers]'] = best_time(
+        camels_spat2nh, {**data_dir, 'data_dir_camels_spat_nh': data_dir_out}, data_gen, set(), 1, MAX_WORKERS,
+        setup=lambda: reset_dir(data_dir_out))
+    # Same runs with the outputs written by the converting process itself (no writer threads)
+    data_gen_sync = {**data_gen, 'write_behind_threads': 0}
+    results['camels_spat2nh[serial, sync writes]'] = best_time(
+        camels_spat2nh, {**data_dir, 'data_dir_camels_spat_nh': data_dir_out}, data_gen_sync, set(), 0, 1,
+        setup=lambda: reset_dir(data_dir_out))
+    results[f'camels_spat2nh[{MAX_WORKERS} workers, sync writes]'] = best_time(
+        camels_spat2nh, {**data_dir, 'data_dir_camels_spat_nh': data_dir_out}, data_gen_sync, set(), 1, MAX_WORKERS,
+        setup=lambda: reset_dir(data_dir_out))
+    shutil.rmtree(data_dir_out, ignore_errors=True)
+    return results
+
+def print_results(results, baseline=None):
+    '''
+    Print the benchmark times, with the speedup over a baseline run
+    Args:
+        results: dict, best wall time in seconds of each benchmark
+        baseline: dict, results of a previous run (saved with --save), optional
+    '''
+    print(f"\n{N_BASINS} basins x {N_YEARS} years, best of {N_REPEATS}" + 
+          (f", {WRITE_LATENCY} s per output write" if WRITE_LATENCY > 0 else ''))
+    print(f"{'benchmark':<42}{'time (s)':>10}" + (f"{'baseline (s)':>14}{'speedup':>10}" if baseline else ''))
+    for name, seconds in results.items():
+        line = f"{name:<42}{seconds:>10.3f}"
+        if baseline and name in baseline:
+            line += f"{baseline[name]:>14.3f}{baseline[name] / seconds:>9.2f}x"
+        print(line)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the CAMELS-spat conversion on a synthetic tree')
+    parser.add_argument('--save', help='save the results to a JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    _, data_gen = load_util_data(str(ROOT_DIR))
+    if WRITE_LATENCY > 0:
+        # Inherited by the worker processes (fork)
+        for output_format, writer in BASIN_WRITERS.items():
+            BASIN_WRITERS[output_format] = add_write_latency(writer, WRITE_LATENCY)
+    # Measure the conversion itself: no cache, store or profiling records
+    data_gen.update({'countries': ['USA', 'CAN'], 'incremental_cache': False, 'consolidated_store': 'none',
+                     'profiling': False})
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir_src = DATA_DIR or tmp_dir
+        if not os.path.exists(os.path.join(data_dir_src, 'basin_data')):
+            print(f"Writing {N_BASINS} synthetic basins x {N_YEARS} years to {data_dir_src}...")
+            make_synthetic_tree(data_dir_src, N_BASINS, N_YEARS)
+        data_dir = {'data_dir_camels_spat': data_dir_src,
+                    'data_dir_camels_spat_nh': os.path.join(data_dir_src, 'nh'),
+                    'relative_path_forcing': 'forcing/lumped',
+                    'relative_path_target': 'observations'}
+        results = run_benchmarks(data_dir, data_gen)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'n_basins': N_BASINS, 'n_years': N_YEARS, 'n_repeats': N_REPEATS,
+                       'max_workers': MAX_WORKERS, 'results': results}, f, indent=1)
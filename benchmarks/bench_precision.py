@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+# Get the root directory of the project with Path
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT_DIR))
+
+from utils.utils import load_util_data
+from camels_spat2nh import processBasinSave2CSV, get_country_dir
+from synthetic_camels_spat import make_synthetic_tree
+
+N_BASINS = int(os.environ.get('BENCH_N_BASINS', 2))
+N_YEARS = int(os.environ.get('BENCH_N_YEARS', 2))
+PRECISIONS = ['float64', 'float32']
+
+def convert_basin(basin_f, data_dir, data_gen, precision):
+    '''
+    Convert one basin in a given precision, measuring its wall time and the peak memory of the conversion
+    Args:
+        basin_f: str, basin folder name
+        data_dir: dict, paths of the synthetic tree as in data_dir.yml
+        data_gen: dict, data from data_general.yml
+        precision: str, float_precision of the run
+    Returns:
+        df: pandas.DataFrame, merged basin data
+        seconds: float, wall time of the conversion
+        peak: int, peak memory traced during the conversion, in bytes
+    '''
+    basin_data_path = os.path.join(data_dir['data_dir_camels_spat'], 'basin_data')
+    data_dir_out = os.path.join(data_dir['data_dir_camels_spat_nh'], precision)
+    country_dir = get_country_dir(data_dir_out, basin_f[:3], len(data_gen['data_sources']))
+    os.makedirs(country_dir, exist_ok=True)
+    input_vars = data_gen['input_vars']
+    input_vars_repeated = set([var for var in input_vars if input_vars.count(var) > 1])
+
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    df = processBasinSave2CSV(basin_f, basin_data_path, country_dir, data_dir['relative_path_forcing'],
+                              data_dir['relative_path_target'], data_gen['data_sources'],
+                              {**data_gen, 'float_precision': precision}, set(), input_vars_repeated,
+                              return_frame=True)
+    seconds = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return df, seconds, peak
+
+if __name__ == '__main__':
+
+    _, data_gen = load_util_data(str(ROOT_DIR))
+    data_gen.update({'countries': ['USA', 'CAN'], 'incremental_cache': False, 'consolidated_store': 'none',
+                     'profiling': False, 'source_threads': 1})
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        print(f"Writing {N_BASINS} synthetic basins x {N_YEARS} years to {tmp_dir}...")
+        data_dir = make_synthetic_tree(tmp_dir, N_BASINS, N_YEARS)
+        basins = sorted(os.listdir(os.path.join(tmp_dir, 'basin_data')))
+
+        print(f"{'basin':<16}{'precision':<10}{'time (s)':>10}{'frame (MB)':>12}{'peak (MB)':>11}"
+              f"{'max abs err':>14}{'max rel err':>14}")
+        for basin_f in basins:
+            reference = None
+            for precision in PRECISIONS:
+                df, seconds, peak = convert_basin(basin_f, data_dir, data_gen, precision)
+                frame_mb = df.memory_usage(deep=True).sum() / 2**20
+                line = f"{basin_f:<16}{precision:<10}{seconds:>10.3f}{frame_mb:>12.2f}{peak / 2**20:>11.2f}"
+                values = df.drop(columns='date').to_numpy(dtype='float64')
+                if reference is None:
+                    reference = values
+                else:
+                    abs_err = np.abs(values - reference)
+                    rel_err = abs_err / np.maximum(np.abs(reference), np.finfo('float32').tiny)
+                    line += f"{np.nanmax(abs_err):>14.2e}{np.nanmax(rel_err):>14.2e}"
+                print(line)
@@ -0,0 +1,142 @@
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Get the root directory of the project with Path
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.append(str(ROOT_DIR))
+
+from utils.utils import reduceDataByDay, load_util_data
+
+N_YEARS = int(os.environ.get('BENCH_N_YEARS', 10))
+N_REPEATS = int(os.environ.get('BENCH_N_REPEATS', 5))
+
+def reduceDataByDayGroupby(dataset, set_vars, sum_vars, input_vars_repeated, forcing_src):
+    '''
+    Reduce the input dataset to daily frequency with one xarray groupby per variable
+    Reference implementation of reduceDataByDay (the original xarray groupby reduction)
+    Args:
+        dataset: xarray.Dataset, input dataset
+        set_vars: list, variables to be averaged
+        sum_vars: list, variables to be summed
+        input_vars_repeated: list, variables that appear repeatedly
+    Returns:
+        daily_data: xarray.Dataset, dataset with daily frequency
+    '''
+
+    # Convert data to daily frequency
+    day_dates = pd.to_datetime(dataset.coords["time"].values).normalize()
+    day_dates = xr.DataArray(day_dates, name="time", dims="time")
+
+    # Group by day and apply appropriate reduction method for each variable
+    daily_data = xr.Dataset()
+
+    # Calculate the difference between consecutive time points
+    time_diff = dataset['time'].diff(dim='time')
+    # Convert the differences to a pandas timedelta for easier analysis
+    time_diff_timedelta = time_diff.to_pandas()
+    # Get the most common frequency
+    inferred_frequency = time_diff_timedelta.mode()[0]
+
+    for variable in dataset.data_vars:
+
+        if variable in input_vars_repeated:
+            var = f'{variable}_{forcing_src}'
+        else:
+            var = variable
+
+        # Check if the frequency is daily - daymet
+        if inferred_frequency == pd.Timedelta(days=1) and variable in variable in set_vars:
+            # Do not aggregate and bring to the day dimension: 1980-01-01 12:00:00 to be 1980-01-01
+            daily_data[var] = dataset[variable].assign_coords(time=day_dates)
+        else:
+            if variable in sum_vars:
+                # print('sum', variable)
+                daily_data[var] = dataset[variable].groupby(day_dates).sum(dim="time")
+            elif variable in set_vars:
+                # print('mean', variable)
+                daily_data[var] = dataset[variable].groupby(day_dates).mean(dim="time")
+        
+        # Add max and min temperature
+        if variable == 'tmean':
+            daily_data[f'{var}_max'] = dataset[variable].groupby(day_dates).max(dim="time")
+            daily_data[f'{var}_min'] = dataset[variable].groupby(day_dates).min(dim="time")
+        elif variable == 't':
+            daily_data[f'{var}_max_{forcing_src}'] = dataset[variable].groupby(day_dates).max(dim="time")
+            daily_data[f'{var}_min_{forcing_src}'] = dataset[variable].groupby(day_dates).min(dim="time")
+
+    return daily_data
+
+def make_hourly_dataset(variables, n_years, start_hour=0, nan_fraction=0.01, seed=0):
+    '''
+    Build an in-memory hourly dataset shaped like a lumped CAMELS-spat forcing file
+    Args:
+        variables: list, data variables to create
+        n_years: int, number of years of hourly data
+        start_hour: int, hour of the first time step (shifts day boundaries)
+        nan_fraction: float, fraction of missing values
+        seed: int, random seed
+    Returns:
+        dataset: xarray.Dataset, dataset with dimensions (time, hru)
+    '''
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp('1980-01-01') + pd.Timedelta(hours=start_hour)
+    times = pd.date_range(start, periods=n_years * 365 * 24, freq='h')
+    dataset = xr.Dataset(coords={'time': times, 'hru': [1]})
+    for variable in variables:
+        values = rng.random((len(times), 1))
+        values[rng.random(len(times)) < nan_fraction] = np.nan
+        dataset[variable] = (('time', 'hru'), values)
+    return dataset
+
+def time_function(func, *args):
+    '''
+    Time a function call, keeping the best of N_REPEATS runs
+    Args:
+        func: callable, function to time
+        args: arguments of the function
+    Returns:
+        best: float, best wall time in seconds
+        result: output of the last call
+    '''
+    best = np.inf
+    for _ in range(N_REPEATS):
+        start_time = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+if __name__ == '__main__':
+
+    data_dir, data_gen = load_util_data(str(ROOT_DIR))
+    input_vars = data_gen['input_vars']
+    sum_vars = data_gen['sum_vars']
+
+    # ERA5-like source: 15 variables, 't' triggers the extra max/min reductions
+    era5_vars = ['mtpr', 'msdwswrf', 'msdwlwrf', 'msnswrf', 'msnlwrf', 'mper', 't',
+                 'u', 'v', 'q', 'sp', 'e', 'rh', 'w', 'phi']
+
+    # Regular days (00-23 UTC) and shifted days, which take the segmented reduction path
+    for start_hour in [0, 13]:
+        dataset = make_hourly_dataset(era5_vars, N_YEARS, start_hour=start_hour)
+
+        time_groupby, daily_groupby = time_function(reduceDataByDayGroupby, dataset, input_vars,
+                                                    sum_vars, {'e', 'phi'}, 'era5')
+        time_kernel, daily_kernel = time_function(reduceDataByDay, dataset, input_vars,
+                                                  sum_vars, {'e', 'phi'}, 'era5')
+
+        # Check both paths give the same daily values
+        max_diff = 0.0
+        for var in daily_groupby.data_vars:
+            assert np.array_equal(daily_groupby['time'].values, daily_kernel['time'].values)
+            assert np.allclose(daily_groupby[var].values, daily_kernel[var].values, equal_nan=True), var
+            max_diff = max(max_diff, float(np.nanmax(np.abs(daily_groupby[var].values - daily_kernel[var].values))))
+
+        print(f"{N_YEARS} years hourly, {len(era5_vars)} variables, first hour {start_hour:02d}:00")
+        print(f"  groupby: {time_groupby:.3f} s")
+        print(f"  kernel:  {time_kernel:.3f} s  (x{time_groupby / time_kernel:.1f}, max abs diff {max_diff:.2e})")
@@ -0,0 +1,169 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Data variables of each source, as in the lumped CAMELS-spat files
+SOURCE_VARIABLES = {
+    'ERA5': ['mtpr', 'msdwswrf', 'msdwlwrf', 'msnswrf', 'msnlwrf', 'mper', 't',
+             'u', 'v', 'q', 'sp', 'e', 'rh', 'w', 'phi'],
+    'EM_Earth': ['prcp', 'tmean'],
+    'RDRS': ['RDRS_v2.1_A_PR0_SFC', 'RDRS_v2.1_P_FB_SFC', 'RDRS_v2.1_P_FI_SFC', 'RDRS_v2.1_P_GZ_SFC',
+             'RDRS_v2.1_P_HR_1.5m', 'RDRS_v2.1_P_HU_1.5m', 'RDRS_v2.1_P_P0_SFC', 'RDRS_v2.1_P_TT_1.5m',
+             'RDRS_v2.1_P_UUC_10m', 'RDRS_v2.1_P_UVC_10m', 'RDRS_v2.1_P_VVC_10m', 'e', 'pet', 'phi'],
+    'daymet': ['prcp', 'tmax', 'tmin', 'srad', 'vp', 'dayl', 'pet'],
+}
+# Hour of the first time step of each source: RDRS days start at 13:00 UTC, daymet is daily at 12:00
+SOURCE_START_HOUR = {
+    'ERA5': 0,
+    'EM_Earth': 0,
+    'RDRS': 13,
+    'daymet': 12,
+}
+# Sources stored as one daily file instead of monthly hourly files
+DAILY_SOURCES = ['daymet']
+
+def make_forcing_dataset(times, variables, rng, nan_fraction=0.0):
+    '''
+    Build a lumped forcing dataset with random values, shaped like a CAMELS-spat file
+    Args:
+        times: pandas.DatetimeIndex, time steps of the file
+        variables: list, data variables to create
+        rng: numpy.random.Generator, random generator
+        nan_fraction: float, fraction of missing values
+    Returns:
+        dataset: xarray.Dataset, dataset with dimensions (time, hru) and the hru metadata variables
+    '''
+    dataset = xr.Dataset(coords={'time': times, 'hru': [0]})
+    for variable in variables:
+        values = rng.random((len(times), 1))
+        if nan_fraction > 0:
+            values[rng.random(len(times)) < nan_fraction] = np.nan
+        dataset[variable] = (('time', 'hru'), values)
+    # Metadata variables without a time dimension, skipped by the reduction
+    dataset['latitude'] = (('hru',), [rng.uniform(30, 60)])
+    dataset['longitude'] = (('hru',), [rng.uniform(-130, -60)])
+    dataset['hruId'] = (('hru',), [0])
+    return dataset
+
+def write_synthetic_basin(basin_data_path, basin_f, start_year, n_years, sources, rng,
+                          relative_path_forc='forcing/lumped', relative_path_targ='observations', nan_fraction=0.0):
+    '''
+    Write the forcing and target files of a synthetic basin
+    Args:
+        basin_data_path: str, path to the basin_data folder
+        basin_f: str, basin folder name (e.g. 'USA_00000000')
+        start_year: int, first year of the forcings
+        n_years: int, number of years of forcings
+        sources: list, data sources to write (keys of SOURCE_VARIABLES)
+        rng: numpy.random.Generator, random generator
+        relative_path_forc: str, forcing folder relative to the basin folder
+        relative_path_targ: str, target folder relative to the basin folder
+        nan_fraction: float, fraction of missing forcing values
+    Returns:
+        n_bytes: int, size of the files written
+    '''
+    forcing_dir = os.path.join(basin_data_path, basin_f, relative_path_forc)
+    target_dir = os.path.join(basin_data_path, basin_f, relative_path_targ)
+    os.makedirs(forcing_dir, exist_ok=True)
+    os.makedirs(target_dir, exist_ok=True)
+    end_year = start_year + n_years - 1
+
+    files = []
+    for src in sources:
+        offset = pd.Timedelta(hours=SOURCE_START_HOUR.get(src, 0))
+        if src in DAILY_SOURCES:
+            times = pd.date_range(pd.Timestamp(start_year, 1, 1) + offset, pd.Timestamp(end_year, 12, 31) + offset, freq='D')
+            files.append((f'{basin_f}_lumped_{src}_{start_year}-{end_year}.nc', times, src))
+            continue
+        # One file per month, the offset sources spill their last hours into the next month's day
+        for year in range(start_year, end_year + 1):
+            for month in range(1, 13):
+                month_start = pd.Timestamp(year, month, 1) + offset
+                times = pd.date_range(month_start, month_start + pd.offsets.MonthBegin(1), freq='h', inclusive='left')
+                files.append((f'{basin_f}_lumped_{src}_{year}-{month:02d}.nc', times, src))
+
+    n_bytes = 0
+    for file_name, times, src in files:
+        file_path = os.path.join(forcing_dir, file_name)
+        make_forcing_dataset(times, SOURCE_VARIABLES[src], rng, nan_fraction).to_netcdf(file_path)
+        n_bytes += os.path.getsize(file_path)
+
+    # Daily flow observations, longer than the forcings and with a duplicated day as in some real files
+    times = pd.date_range(pd.Timestamp(start_year - 1, 6, 1), pd.Timestamp(end_year + 1, 3, 1), freq='D')
+    times = times.insert(len(times) // 2, times[len(times) // 2])
+    target = xr.Dataset({'q_obs': (('time',), rng.random(len(times)) * 10)}, coords={'time': times})
+    file_path = os.path.join(target_dir, f'{basin_f}_daily_flow_observations.nc')
+    target.to_netcdf(file_path)
+    return n_bytes + os.path.getsize(file_path)
+
+def get_synthetic_basins(n_basins, countries=('USA', 'CAN')):
+    '''
+    Name synthetic basins, spread over countries
+    Args:
+        n_basins: int, number of basins
+        countries: tuple, country codes
+    Returns:
+        basins: list, basin folder names (e.g. 'USA_00000000', 'CAN_00AA000')
+    '''
+    basins = []
+    for i in range(n_basins):
+        country = countries[i % len(countries)]
+        basin_id = f'{i:08d}' if country == 'USA' else f'{i % 100:02d}AA{i // 100:03d}'
+        basins.append(f'{country}_{basin_id}')
+    return basins
+
+def make_synthetic_tree(data_dir_src, n_basins=4, n_years=2, start_year=1990, sources=None,
+                        countries=('USA', 'CAN'), nan_fraction=0.0, seed=0):
+    '''
+    Write a synthetic CAMELS-spat tree ({data_dir_src}/basin_data/XXX_id/...) to run the conversion offline
+    Args:
+        data_dir_src: str, root of the synthetic dataset
+        n_basins: int, number of basins
+        n_years: int, number of years of forcings per basin
+        start_year: int, first year of the forcings
+        sources: list, data sources to write (all of SOURCE_VARIABLES if None)
+        countries: tuple, country codes of the basins
+        nan_fraction: float, fraction of missing forcing values
+        seed: int, random seed
+    Returns:
+        data_dir: dict, paths as in data_dir.yml (the output folder is {data_dir_src}/nh)
+    '''
+    sources = list(SOURCE_VARIABLES) if sources is None else sources
+    basin_data_path = os.path.join(data_dir_src, 'basin_data')
+    data_dir = {'data_dir_camels_spat': data_dir_src,
+                'data_dir_camels_spat_nh': os.path.join(data_dir_src, 'nh'),
+                'relative_path_forcing': 'forcing/lumped',
+                'relative_path_target': 'observations'}
+
+    rng = np.random.default_rng(seed)
+    for basin_f in get_synthetic_basins(n_basins, countries):
+        write_synthetic_basin(basin_data_path, basin_f, start_year, n_years, sources, rng,
+                              data_dir['relative_path_forcing'], data_dir['relative_path_target'], nan_fraction)
+    # No unusable basins, the conversion reads this file from the output folder
+    os.makedirs(data_dir['data_dir_camels_spat_nh'], exist_ok=True)
+    pd.DataFrame(columns=['Country', 'Station_id', 'Missing', 'Reason']).to_csv(
+        os.path.join(data_dir['data_dir_camels_spat_nh'], 'camels_spat_unusable.csv'), index=False)
+    return data_dir
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Write a synthetic CAMELS-spat tree for offline runs and benchmarks')
+    parser.add_argument('data_dir', help='root of the synthetic dataset (basin_data/ is created inside)')
+    parser.add_argument('--basins', type=int, default=4, help='number of basins')
+    parser.add_argument('--years', type=int, default=2, help='number of years of forcings per basin')
+    parser.add_argument('--start-year', type=int, default=1990, help='first year of the forcings')
+    parser.add_argument('--sources', nargs='+', choices=list(SOURCE_VARIABLES), default=list(SOURCE_VARIABLES),
+                        help='data sources to write')
+    parser.add_argument('--nan-fraction', type=float, default=0.0, help='fraction of missing forcing values')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    data_dir = make_synthetic_tree(args.data_dir, args.basins, args.years, args.start_year, args.sources,
+                                   nan_fraction=args.nan_fraction, seed=args.seed)
+    print(f"{args.basins} basins x {args.years} years written to", os.path.join(args.data_dir, 'basin_data'))
+    print('To convert them, point utils/data_dir.yml to:')
+    for key, value in data_dir.items():
+        print(f'{key}: {value}')
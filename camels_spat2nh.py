@@ -1,14 +1,27 @@
 import os
 import sys
 import xarray as xr
-import pandas as pd
 import time
-from functools import reduce
 
-from functools import partial
+import argparse
+import resource
+import contextlib
 import concurrent.futures
-
-from utils.utils import reduceDataByDay, load_util_data, get_unusable_basins
+from multiprocessing.util import Finalize
+
+from utils.utils import (NETCDF_LOCK, reduce_files_by_day, iter_forcing_files, merge_basin_frames, 
+                         get_source_steps_per_day, daily_files_to_frame, load_util_data, get_unusable_basins)
+from utils.writers import (BASIN_WRITERS, OUTPUT_EXTENSIONS, get_basin_output_path, write_basin, read_basin, 
+                           start_write_queue, close_write_queue, queue_write)
+from utils.stats import summarize_basin_frame, write_basin_summary
+from utils.discovery import get_basin_index, scan_basin, list_folder_files
+from utils.catalogue import build_basin_catalogue, filter_basins, print_catalogue_summary
+from utils.store import get_store_path, get_store_dates, read_store_basins, append_basin_to_store
+from utils.profiling import (set_verbose, vprint, new_basin_record, get_source_record, add_time, stage_timer, 
+                             finish_basin_record, cprofile_basin, summarize_profile)
+from utils.journal import FINISHED_STATES, get_journal_path, journal_basins, read_journal, print_journal_summary
+from utils.cache import (get_cache_dir, get_source_variables, get_source_manifest, get_cached_source_manifest, 
+                         get_basin_manifest, read_manifest, write_manifest, load_cached_source, save_cached_source)
 
 # Get the current working directory of the notebook
 current_dir = os.getcwd()
@@ -16,14 +29,20 @@ current_dir = os.getcwd()
 # root_dir = os.path.abspath(os.path.join(current_dir, '..', '..'))
 ROOT_DIR = os.path.abspath(current_dir)
 sys.path.append(ROOT_DIR)
+# Metadata and basin lists shipped with the scripts (found from any working directory)
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
 MULTIPROCESSING = 0
 MAX_WORKERS = int(os.environ.get('SLURM_CPUS_PER_TASK', 32))
+# Shard of the basin list processed by this job (SLURM job arrays)
+SHARD_INDEX = int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+SHARD_COUNT = int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1))
 ONLY_TESTING = 0
+# Reader threads allowed per CPU (they mostly wait on the file system)
+READER_THREADS_PER_CPU = 2
 
-FILTER_BY_CYRIL = True
-
-def camels_spat2nh(data_dir, data_gen, unusuable_basins):
+def camels_spat2nh(data_dir, data_gen, unusuable_basins, multiprocessing=MULTIPROCESSING, max_workers=MAX_WORKERS,
+                   shard_index=SHARD_INDEX, shard_count=SHARD_COUNT, basin_index=None):
 
     # **Load Data**
     ## Dirs data
@@ -33,249 +52,821 @@ def camels_spat2nh(data_dir, data_gen, unusuable_basins):
     relative_path_targ = data_dir['relative_path_target']
     ## Basins data
     basin_data_path = os.path.join(data_dir_src, 'basin_data')
-    list_basin_files = sorted(os.listdir(basin_data_path))
+    # Forcing and target files of every basin, listed once for the whole run
+    if basin_index is None:
+        # Shards only read the saved index: several tasks of a job array would rewrite it concurrently
+        basin_index = get_basin_index(data_dir, data_gen, reuse=data_gen.get('reuse_basin_index', False), save=shard_count == 1)
 
     # Input data
     input_vars = data_gen['input_vars']
     # Get the input variables that appear repeatedly
     input_vars_repeated = set([var for var in input_vars if input_vars.count(var) > 1])
 
-    # Drop if file already exists
-    for basin_f in list_basin_files[:]:
+    ## General data
+    countries = data_gen['countries']
+    data_sources = data_gen['data_sources']
+    output_format = data_gen.get('output_format', 'csv')
+
+    # Basins of the countries on disk, filtered by the basin_filters of data_general.yml
+    selected = get_selected_basins(data_dir, data_gen, basin_index, summary=True)
+    list_basin_files = list(selected['basin_f'])
+    # Forcing bytes of each basin, to balance the shards and start with the longest basins
+    basin_costs = dict(zip(selected['basin_f'], selected['cost']))
+
+    # Keep this job's shard of the basins (split before skipping existing files, so that all shards agree)
+    if shard_count > 1:
+        list_basin_files = split_basins_into_shards(basin_costs, shard_count)[shard_index]
+        print(f'Shard {shard_index + 1}/{shard_count}:', len(list_basin_files), 'basins')
+    shard_basin_files = list_basin_files[:]
+
+    # Journal of the basin states of this shard, read back by --resume
+    journal_path = get_journal_path(data_dir_out, shard_index, shard_count) if data_gen.get('journal', True) else None
+    if data_gen.get('resume', False):
+        journal = read_journal(data_dir_out)
+        # Basins started but not finished (killed or failed) are converted again, even if they have an output file
+        finished = set(basin_f for basin_f in list_basin_files 
+                       if basin_f in journal and journal[basin_f]['state'] in FINISHED_STATES)
+        unfinished = [basin_f for basin_f in list_basin_files 
+                      if basin_f in journal and journal[basin_f]['state'] in ('running', 'failed')]
+        for basin_f in unfinished:
+            csv_file_path = get_basin_output_path(get_country_dir(data_dir_out, basin_f[:3], len(data_sources)), basin_f[4:], output_format)
+            if os.path.exists(csv_file_path):
+                os.remove(csv_file_path)
+        list_basin_files = [basin_f for basin_f in list_basin_files if basin_f not in finished]
+        print(f'Resuming: {len(finished)} basins finished, {len(unfinished)} interrupted or failed basins requeued')
+
+    # Drop if file already exists (with the cache, only files without manifest: the others are checked for changes)
+    use_cache = data_gen.get('incremental_cache', False)
+    output_files = list_output_files(data_dir_out, set(basin_f[:3] for basin_f in shard_basin_files), len(data_sources))
+    for basin_f in shard_basin_files:
+        csv_file_path = get_basin_output_path(get_country_dir(data_dir_out, basin_f[:3], len(data_sources)), basin_f[4:], output_format)
+        if os.path.basename(csv_file_path) + '.tmp' in output_files[basin_f[:3]]:
+            # Partial output left by a killed run
+            os.remove(csv_file_path + '.tmp')
+    existing = set()
+    for basin_f in list_basin_files:
         # Check if file exists
-        csv_file_path = os.path.join(data_dir_out, f'CAMELS_spat_{basin_f[0:3]}', basin_f[4:] + '.csv')
-        if os.path.exists(csv_file_path):
+        csv_file_path = get_basin_output_path(get_country_dir(data_dir_out, basin_f[:3], len(data_sources)), basin_f[4:], output_format)
+        if os.path.basename(csv_file_path) in output_files[basin_f[:3]]:
             print(f"File {csv_file_path} already exists")
             if basin_f[4:] in unusuable_basins:
                 # Delete file
                 os.remove(csv_file_path)
+            elif use_cache and os.path.exists(os.path.join(get_cache_dir(data_dir_out, data_gen, basin_f), 'basin.json')):
+                continue
 
-            # Remove from list
-            list_basin_files.remove(basin_f)
+            existing.add(basin_f)
+    list_basin_files = [basin_f for basin_f in list_basin_files if basin_f not in existing]
 
     print('Basins to process:', len(list_basin_files))
-       
-    ## General data
-    countries = data_gen['countries']
-    data_sources = data_gen['data_sources']
     
-    # Filter folders by country name (3 first letters) - create a dictionary
-    basin_data_path_dict = {}
-    for country in countries:
-        basin_data_path_dict[country] = [basin for basin in list_basin_files if basin[:3] == country]
-
-    # ## Do not delete unless you know what you are doing
-    # # # Filtering by cyril basins
-    # # if FILTER_BY_CYRIL:
-    # #     cyril_list = get_cyril_basins()
-    # # else:
-    # #     cyril_list = None
-
-    # # print('Cyril basins:', len(cyril_list))
-    # # print(cyril_list[:5])
-    # # print(cyril_list[-5:])
-
-    # # return
+    # Group the basins by country name (3 first letters) - create a dictionary
+    basin_data_path_dict = {country: [] for country in countries}
+    for basin_f in list_basin_files:
+        basin_data_path_dict[basin_f[:3]].append(basin_f)
 
     ## Process data for each basin and save to csv file
+    basin_tasks = []
     for country in countries[:]:
         # Create a folder for each country
         # Check if only testing
-        if ONLY_TESTING:
-            country_dir = os.path.join(data_dir_out, f'CAMELS_spat_{country}_testing')
-        else:
-            country_dir = os.path.join(data_dir_out, f'CAMELS_spat_{country}_{len(data_sources)}sources')
+        country_dir = get_country_dir(data_dir_out, country, len(data_sources))
             
         if not os.path.exists(country_dir ):
             os.makedirs(country_dir)
+
+        basin_tasks += [(basin_f, country_dir) for basin_f in basin_data_path_dict[country]]
+
+    # Reader threads of each basin, within the CPU and open-file budget of all the processes
+    data_gen = dict(data_gen)
+    data_gen['source_threads'], data_gen['prefetch_files'] = get_reader_threads(data_gen, max_workers if multiprocessing else 1)
+    if data_gen.get('cprofile', False):
+        # cProfile only records the thread that enables it: read and reduce in the basin thread
+        data_gen['source_threads'], data_gen['prefetch_files'] = 1, 0
+        print("cProfile: reading the sources in the basin thread (source_threads 1, prefetch_files 0)")
+
+    # Arguments shared by every basin
+    basin_config = {'basin_data_path': basin_data_path, 
+                    'relative_path_forc': relative_path_forc,
+                    'relative_path_targ': relative_path_targ, 
+                    'data_sources': data_sources, 
+                    'data_gen': data_gen, 
+                    'unusuable_basins': unusuable_basins,
+                    'input_vars_repeated': input_vars_repeated}
+
+    # Consolidated (basin, date) store, appended in this process as basins finish
+    store_group = data_gen.get('consolidated_store', 'none')
+    if store_group != 'none' and shard_count > 1:
+        print("Shards cannot share a consolidated store: run with --consolidate once all shards are done")
+        store_group = 'none'
+    basin_config['return_frame'] = store_group != 'none'
+
+    # Per-basin stage timings, one JSON lines file per process
+    profile_dir = get_profile_dir(data_dir_out, data_gen)
+    basin_config['profile_dir'] = profile_dir
+    basin_config['cprofile'] = data_gen.get('cprofile', False)
+    if profile_dir is not None:
+        print('Profiling records ->', profile_dir)
+
+    basin_config['journal_path'] = journal_path
+    journal_basins(journal_path, [basin_f for basin_f, _ in basin_tasks], 'pending')
         
-        if MULTIPROCESSING:
-
-            print(f"Processing {country}...")
-            with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                # Define a partial function with fixed non-iterable arguments       
-                partial_process = partial(processBasinSave2CSV, basin_data_path=basin_data_path, 
-                                    country_dir=country_dir, 
-                                    relative_path_forc=relative_path_forc,
-                                    relative_path_targ=relative_path_targ, 
-                                    data_sources=data_sources, 
-                                    data_gen=data_gen, 
-                                    unusuable_basins=unusuable_basins,
-                                    input_vars_repeated=input_vars_repeated)
-
-                # Process each basin concurrently
-                futures = [executor.submit(partial_process, basin_f) for basin_f in basin_data_path_dict[country]]
-
-                # Wait for all tasks to complete and handle exceptions
-                for future in concurrent.futures.as_completed(futures):
-                    try:
-                        result = future.result()  # Get the result if needed
-                    except Exception as e:
-                        print(f"Error processing {future}: {e}")
+    if multiprocessing:
+
+        # Longest basins first, so that no worker is left with a large basin at the end
+        basin_tasks = sorted(basin_tasks, key=lambda task: basin_costs[task[0]], reverse=True)
+
+        print(f"Processing {len(basin_tasks)} basins with {max_workers} workers...")
+        # The shared arguments are sent once to each worker, tasks only carry the basin, its files and output folder
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=init_basin_worker, 
+                                                    initargs=(basin_config,)) as executor:
+
+            # Process each basin concurrently
+            futures = {executor.submit(process_basin_worker, basin_f, country_dir, basin_index['basins'][basin_f]): basin_f 
+                       for basin_f, country_dir in basin_tasks}
+
+            # Wait for all tasks to complete and handle exceptions
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    df_merged = future.result()
+                    if df_merged is not None:
+                        append_basin_output(data_dir_out, data_gen, store_group, futures[future], df_merged)
+                except Exception as e:
+                    print(f"Error processing {futures[future]}: {e}")
+                    # Conversion errors are journaled by the worker, record the others here (worker killed, store)
+                    if future.exception() is None or isinstance(e, concurrent.futures.process.BrokenProcessPool):
+                        journal_basins(journal_path, [futures[future]], 'failed', error=repr(e))
 
-        else:
-            for basin_f in basin_data_path_dict[country]:
-                processBasinSave2CSV(basin_f, basin_data_path, country_dir, relative_path_forc, 
-                                     relative_path_targ, data_sources, data_gen, unusuable_basins, input_vars_repeated)
+    else:
+        # Writer threads write each basin while the next one is converted
+        start_write_queue(data_gen.get('write_behind_threads', 1), data_gen.get('write_behind_max_mb', 256))
+        try:
+            for basin_f, country_dir in basin_tasks:
+                df_merged = processBasinSave2CSV(basin_f, country_dir=country_dir, basin_files=basin_index['basins'][basin_f], 
+                                                 **basin_config)
+                if df_merged is not None:
+                    append_basin_output(data_dir_out, data_gen, store_group, basin_f, df_merged)
+        finally:
+            close_write_queue()
+
+    # Add the basins converted in previous runs to the store
+    if store_group != 'none':
+        consolidate_outputs(data_dir_out, data_gen, unusuable_basins, shard_basin_files)
+
+    # Record the basins of this shard that have an output file, for verify_outputs
+    output_files = list_output_files(data_dir_out, countries, len(data_sources))
+    produced = [basin_f for basin_f in shard_basin_files if basin_f[:3] in countries and basin_f[4:] not in unusuable_basins 
+                and basin_f[4:] + OUTPUT_EXTENSIONS[output_format] in output_files[basin_f[:3]]]
+    write_shard_manifest(data_dir_out, shard_index, shard_count, produced)
+    if journal_path is not None:
+        print_journal_summary(read_journal(data_dir_out), [basin_f for basin_f, _ in basin_tasks])
+
+    if profile_dir is not None:
+        summarize_profile(profile_dir)
+
+def get_basin_catalogue(data_dir, data_gen, basin_index):
+    '''
+    Build the basin catalogue of a run from the basin index, the metadata, the unusable basins and the basin lists
+    Args:
+        data_dir: dict, data from data_dir.yml
+        data_gen: dict, data from data_general.yml
+        basin_index: dict, basin index of the run
+    Returns:
+        catalogue: pandas.DataFrame, basin catalogue (see build_basin_catalogue)
+    '''
+    basin_lists = {name: os.path.join(DATA_DIR, file_name) 
+                   for name, file_name in (data_gen.get('basin_lists') or {}).items()}
+    return build_basin_catalogue(basin_index, 
+                                 metadata_file=os.path.join(DATA_DIR, data_gen['camels_spat_metadata']),
+                                 unusable_file=os.path.join(data_dir['data_dir_camels_spat_nh'], data_gen['camels_spat_unusable']),
+                                 basin_lists=basin_lists)
+
+def get_selected_basins(data_dir, data_gen, basin_index, summary=False):
+    '''
+    Select the basins of a run: the basins of the countries on disk, filtered by the basin_filters of data_general.yml
+    (the same selection for the conversion, its shards, --verify and --consolidate)
+    Args:
+        data_dir: dict, data from data_dir.yml
+        data_gen: dict, data from data_general.yml
+        basin_index: dict, basin index of the run
+        summary: bool, whether to print the number of basins of the catalogue and of the selection
+    Returns:
+        selected: pandas.DataFrame, selected rows of the basin catalogue
+    '''
+    catalogue = get_basin_catalogue(data_dir, data_gen, basin_index)
+    selected = filter_basins(catalogue, countries=data_gen['countries'], **(data_gen.get('basin_filters') or {}))
+    if summary:
+        print_catalogue_summary(catalogue, selected)
+    return selected
+
+def get_profile_dir(data_dir_out, data_gen):
+    '''
+    Get the profiling folder of the run (shared by the shards of a SLURM job array)
+    Args:
+        data_dir_out: str, path to the output directory
+        data_gen: dict, data from data_general.yml
+    Returns:
+        profile_dir: str, path to the profiling folder (None if profiling is off)
+    '''
+    if not (data_gen.get('profiling', False) or data_gen.get('cprofile', False)):
+        return None
+    run_id = os.environ.get('SLURM_ARRAY_JOB_ID') or os.environ.get('SLURM_JOB_ID') or time.strftime('%Y%m%d-%H%M%S')
+    return os.path.join(data_dir_out, 'profiling', run_id)
+
+def append_basin_output(data_dir_out, data_gen, store_group, basin_f, df_merged):
+    '''
+    Append a converted basin to its consolidated store
+    Args:
+        data_dir_out: str, path to the output directory
+        data_gen: dict, data from data_general.yml
+        store_group: str, 'country' (one store per country) or 'all' (one store for all countries)
+        basin_f: str, basin folder name (e.g. 'USA_01013500')
+        df_merged: pandas.DataFrame, converted basin data with a 'date' column
+    '''
+    store_format = data_gen.get('consolidated_store_format', 'netcdf')
+    group = basin_f[:3] if store_group == 'country' else 'all'
+    store_path = get_store_path(data_dir_out, group, len(data_gen['data_sources']), store_format)
+    dates = get_store_dates(data_gen.get('consolidated_store_dates', ['1950-01-01', '2023-12-31']))
+    append_basin_to_store(store_path, basin_f[4:], df_merged, dates, store_format, country=basin_f[:3])
+
+def consolidate_outputs(data_dir_out, data_gen, unusuable_basins, list_basin_files):
+    '''
+    Append the converted basins that are not yet in their consolidated store, reading their output files
+    Args:
+        data_dir_out: str, path to the output directory
+        data_gen: dict, data from data_general.yml
+        unusuable_basins: set, unusable basins
+        list_basin_files: list, basin folder names to consolidate
+    '''
+    store_group = data_gen.get('consolidated_store', 'none')
+    if store_group == 'none':
+        store_group = 'country'
+    store_format = data_gen.get('consolidated_store_format', 'netcdf')
+    output_format = data_gen.get('output_format', 'csv')
+    n_sources = len(data_gen['data_sources'])
+
+    stored = {}
+    output_files = list_output_files(data_dir_out, data_gen['countries'], n_sources)
+    for basin_f in sorted(list_basin_files):
+        if basin_f[:3] not in data_gen['countries'] or basin_f[4:] in unusuable_basins:
+            continue
+        file_path = get_basin_output_path(get_country_dir(data_dir_out, basin_f[:3], n_sources), basin_f[4:], output_format)
+        if os.path.basename(file_path) not in output_files[basin_f[:3]]:
+            continue
+
+        group = basin_f[:3] if store_group == 'country' else 'all'
+        if group not in stored:
+            stored[group] = set(read_store_basins(get_store_path(data_dir_out, group, n_sources, store_format), store_format))
+        if basin_f[4:] in stored[group]:
+            continue
+
+        print(f"Adding {basin_f} to the {group} store...")
+        append_basin_output(data_dir_out, data_gen, store_group, basin_f, read_basin(file_path, output_format))
+        stored[group].add(basin_f[4:])
+
+def get_country_dir(data_dir_out, country, n_sources):
+    '''
+    Get the output folder of a country
+    Args:
+        data_dir_out: str, path to the output directory
+        country: str, country code (e.g. 'USA')
+        n_sources: int, number of forcing data sources
+    Returns:
+        country_dir: str, path to the country output folder
+    '''
+    # Check if only testing
+    if ONLY_TESTING:
+        return os.path.join(data_dir_out, f'CAMELS_spat_{country}_testing')
+    return os.path.join(data_dir_out, f'CAMELS_spat_{country}_{n_sources}sources')
+
+def list_output_files(data_dir_out, countries, n_sources):
+    '''
+    List the output files of each country with one directory scan per country
+    Args:
+        data_dir_out: str, path to the output directory
+        countries: list, country codes
+        n_sources: int, number of forcing data sources
+    Returns:
+        output_files: dict, country -> set of file names in its output folder
+    '''
+    return {country: list_folder_files(get_country_dir(data_dir_out, country, n_sources)) for country in countries}
+
+def get_reader_threads(data_gen, n_processes):
+    '''
+    Get the number of sources read concurrently and of files loaded ahead in each basin,
+    capped so that all processes together stay within the CPUs and the open-file limit
+    Args:
+        data_gen: dict, data from data_general.yml ('source_threads' and 'prefetch_files')
+        n_processes: int, number of processes converting basins at the same time
+    Returns:
+        source_threads: int, sources of a basin read concurrently
+        prefetch_files: int, files loaded ahead per source (0: no prefetch)
+    '''
+    source_threads = max(1, int(data_gen.get('source_threads', 1)))
+    prefetch_files = max(0, int(data_gen.get('prefetch_files', 0)))
+
+    # Reader threads mostly wait on the file system: allow READER_THREADS_PER_CPU per CPU, 
+    # and a few file handles per thread (netCDF/HDF5 and the output files)
+    n_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    budget = min(READER_THREADS_PER_CPU * n_cpus, resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 4) // n_processes
+    budget = max(1, budget)
+    if source_threads * max(prefetch_files, 1) > budget:
+        source_threads = min(source_threads, budget)
+        prefetch_files = min(prefetch_files, budget // source_threads)
+        print(f"Reader threads capped to {source_threads} sources x {prefetch_files} files ahead per basin "
+              f"for {n_processes} processes")
+    return source_threads, prefetch_files
+
+def split_basins_into_shards(basin_costs, shard_count):
+    '''
+    Split the basins into shards of similar total cost, deterministically
+    Basins are assigned from the most to the least expensive to the shard with the lowest load
+    Args:
+        basin_costs: dict, cost of each basin folder name
+        shard_count: int, number of shards
+    Returns:
+        shards: list, sorted basin folder names of each shard
+    '''
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+    for basin_f in sorted(basin_costs, key=lambda basin_f: (-basin_costs[basin_f], basin_f)):
+        i = min(range(shard_count), key=lambda k: (loads[k], len(shards[k]), k))
+        shards[i].append(basin_f)
+        loads[i] += basin_costs[basin_f]
+    return [sorted(shard) for shard in shards]
+
+def write_shard_manifest(data_dir_out, shard_index, shard_count, produced):
+    '''
+    Write the list of basins with an output file produced by one shard
+    Args:
+        data_dir_out: str, path to the output directory
+        shard_index: int, index of the shard (0-based)
+        shard_count: int, number of shards
+        produced: list, basin folder names with an output file
+    '''
+    shards_dir = os.path.join(data_dir_out, 'shards')
+    if not os.path.exists(shards_dir):
+        os.makedirs(shards_dir)
+    with open(os.path.join(shards_dir, f'shard_{shard_index}_of_{shard_count}.txt'), 'w') as f:
+        f.writelines(f'{basin_f}\n' for basin_f in produced)
+
+def verify_outputs(data_dir, data_gen, unusuable_basins, shard_count=SHARD_COUNT):
+    '''
+    Check that every expected basin has an output file, produced by exactly one shard
+    Args:
+        data_dir: dict, data from data_dir.yml
+        data_gen: dict, data from data_general.yml
+        unusuable_basins: set, unusable basins
+        shard_count: int, number of shards of the run
+    Returns:
+        ok: bool, whether the outputs are complete
+    '''
+    data_dir_out = data_dir['data_dir_camels_spat_nh']
+    countries = data_gen['countries']
+    n_sources = len(data_gen['data_sources'])
+    output_format = data_gen.get('output_format', 'csv')
+
+    # Same selection as the conversion (basin_filters), without the unusable basins that get no output
+    basin_index = get_basin_index(data_dir, data_gen, reuse=data_gen.get('reuse_basin_index', False))
+    expected = set(basin_f for basin_f in get_selected_basins(data_dir, data_gen, basin_index)['basin_f'] 
+                   if basin_f[4:] not in unusuable_basins)
+
+    # Merge the shard manifests
+    counts = {}
+    missing_shards = []
+    for shard_index in range(shard_count):
+        manifest = os.path.join(data_dir_out, 'shards', f'shard_{shard_index}_of_{shard_count}.txt')
+        if not os.path.exists(manifest):
+            missing_shards.append(shard_index)
+            continue
+        with open(manifest, 'r') as f:
+            for basin_f in f.read().split():
+                counts[basin_f] = counts.get(basin_f, 0) + 1
+
+    output_files = list_output_files(data_dir_out, countries, n_sources)
+    missing = sorted(basin_f for basin_f in expected 
+                     if basin_f[4:] + OUTPUT_EXTENSIONS[output_format] not in output_files[basin_f[:3]])
+    not_recorded = sorted(basin_f for basin_f in expected if basin_f not in counts)
+    duplicated = sorted(basin_f for basin_f, count in counts.items() if count > 1)
+    unexpected = sorted(basin_f for basin_f in counts if basin_f not in expected)
+
+    print('Expected basins:', len(expected))
+    print('Missing shard manifests:', missing_shards)
+    print('Missing output files:', len(missing), missing[:20])
+    print('Not recorded by any shard:', len(not_recorded), not_recorded[:20])
+    print('Recorded by more than one shard:', len(duplicated), duplicated[:20])
+    print('Recorded but not expected:', len(unexpected), unexpected[:20])
+
+    return not (missing_shards or missing or not_recorded or duplicated or unexpected)
+
+# Arguments shared by all the basins processed in a worker, set once by init_basin_worker
+WORKER_CONFIG = {}
+
+def init_basin_worker(basin_config):
+    '''
+    Initialize a worker process with the arguments shared by all basins
+    Args:
+        basin_config: dict, keyword arguments of processBasinSave2CSV common to all basins
+    '''
+    WORKER_CONFIG.update(basin_config)
+    set_verbose(basin_config['data_gen'].get('verbose', False))
+    # Writer threads of the worker, flushed when the pool shuts the worker down
+    start_write_queue(basin_config['data_gen'].get('write_behind_threads', 1), 
+                      basin_config['data_gen'].get('write_behind_max_mb', 256))
+    Finalize(None, close_write_queue, exitpriority=10)
+
+def process_basin_worker(basin_f, country_dir, basin_files=None):
+    '''
+    Process one basin in a worker process initialized with init_basin_worker
+    Args:
+        basin_f: str, basin folder name (e.g. 'USA_01013500')
+        country_dir: str, output folder of the basin's country
+        basin_files: dict, entry of the basin in the basin index (scanned by the worker if None)
+    '''
+    return processBasinSave2CSV(basin_f, country_dir=country_dir, basin_files=basin_files, **WORKER_CONFIG)
                                   
 def processBasinSave2CSV(basin_f, basin_data_path, country_dir, 
                          relative_path_forc, relative_path_targ, 
                          data_sources, data_gen, unusuable_basins,
                          input_vars_repeated,
-                         cyril_list=None):
+                         cyril_list=None, return_frame=False,
+                         profile_dir=None, cprofile=False, basin_files=None, journal_path=None):
+    '''
+    Convert a basin to a NeuralHydrology input file, recording its profile and its state in the run journal
+    Args:
+        basin_f: str, basin folder name (e.g. 'USA_01013500')
+        basin_data_path: str, path to the basin_data folder
+        country_dir: str, output folder of the basin's country
+        relative_path_forc: str, forcing folder relative to the basin folder
+        relative_path_targ: str, target folder relative to the basin folder
+        data_sources: list, forcing data sources
+        data_gen: dict, data from data_general.yml
+        unusuable_basins: set, unusable basins
+        input_vars_repeated: set, variables that appear repeatedly
+        return_frame: bool, whether to return the converted DataFrame
+        profile_dir: str, folder of the profiling records (no records if None)
+        cprofile: bool, whether to dump cProfile stats of the basin to profile_dir
+        basin_files: dict, entry of the basin in the basin index (scanned here if None)
+        journal_path: str, run journal of the basin states (no journal if None)
+    Returns:
+        df_merged: pandas.DataFrame, converted basin (None if skipped or return_frame is False)
+    '''
+    record = new_basin_record(basin_f) if profile_dir is not None else None
+    journal_basins(journal_path, [basin_f], 'running')
+    start_time = time.time()
 
+    def finish(status, error=None):
+        if error is not None:
+            finish_basin_record(record, 'error', profile_dir, error=repr(error))
+            journal_basins(journal_path, [basin_f], 'failed', seconds=round(time.time() - start_time, 3), error=repr(error))
+        else:
+            finish_basin_record(record, status, profile_dir)
+            journal_basins(journal_path, [basin_f], status, seconds=round(time.time() - start_time, 3))
+
+    def on_written(error):
+        # Called by the writer thread once the output is written: the basin is only done then
+        if error is not None:
+            print(f"Error writing {basin_f}: {error}")
+        finish('done', error)
+
+    try:
+        with cprofile_basin(basin_f, profile_dir, enabled=cprofile and profile_dir is not None):
+            status, df_merged = convertBasin(basin_f, basin_data_path, country_dir, relative_path_forc, relative_path_targ, 
+                                             data_sources, data_gen, unusuable_basins, input_vars_repeated, record, basin_files,
+                                             on_written)
+    except Exception as e:
+        finish('failed', e)
+        raise
+    if status != 'queued':
+        finish(status)
+
+    return df_merged if return_frame else None
+
+def convertBasin(basin_f, basin_data_path, country_dir, relative_path_forc, relative_path_targ, 
+                 data_sources, data_gen, unusuable_basins, input_vars_repeated, record=None, basin_files=None,
+                 on_written=None):
+    '''
+    Reduce the forcings of a basin to daily values, merge them with the targets and save them
+    Args:
+        (see processBasinSave2CSV)
+        record: dict, profiling record of the basin, optional
+        basin_files: dict, entry of the basin in the basin index (scanned here if None)
+        on_written: callable, if given the output is handed off to the write queue of the process (see queue_write)
+                    and on_written is called with None once written, or with the write error
+    Returns:
+        status: str, 'done', 'skipped', 'up_to_date' or 'queued' (handed off to the write queue)
+        df_merged: pandas.DataFrame, converted basin (None if not converted)
+    '''
     print(f"Let's try {basin_f}...")
             
     basin_id = basin_f.split('_')[-1]
-    csv_file_path = os.path.join(country_dir, basin_id + '.csv')
+    output_format = data_gen.get('output_format', 'csv')
+    csv_file_path = get_basin_output_path(country_dir, basin_id, output_format)
 
-    print('csv_file_path', csv_file_path, os.path.exists(csv_file_path))
+    vprint('csv_file_path', csv_file_path, os.path.exists(csv_file_path))
 
     if os.path.exists(csv_file_path):
         print(f"File {csv_file_path} already exists")
         if basin_f[4:] in unusuable_basins:
             # Delete file
-            os.remove(csv_file_path)               
+            os.remove(csv_file_path)
+            return 'skipped', None
     elif basin_f[4:] in unusuable_basins:
         print(f"Skipping basin {basin_f} - unusable basin")
-    else:
-        print('\n', basin_f[:3], '->', basin_id)
-        df_src_dict = {}
-        for src in data_sources:
-
-            folder2load = os.path.join(basin_data_path, basin_f, relative_path_forc)
-            # print('folder2load', folder2load)
-            eras_files = sorted([f for f in os.listdir(folder2load) if src in f])
-
-            print(f'{src}_files', len(eras_files), '->', folder2load)
-            
-            # # Check if only testing
-            # if ONLY_TESTING:
-            #     continue
+        return 'skipped', None
+
+    folder2load = os.path.join(basin_data_path, basin_f, relative_path_forc)
+    target_file = os.path.join(basin_data_path, basin_f, relative_path_targ, f'{basin_f}_daily_flow_observations.nc')
+    if basin_files is None:
+        with stage_timer(record, 'scan'):
+            basin_files = scan_basin(basin_data_path, basin_f, relative_path_forc, relative_path_targ, data_sources)
+    # Forcing files of each source (temporary files are skipped by the scan)
+    source_files = {src: [file[0] for file in basin_files['sources'][src]] for src in data_sources}
+
+    # Manifests of the inputs and settings, to reuse the cached sources that did not change
+    use_cache = data_gen.get('incremental_cache', False)
+    if use_cache:
+        cache_dir = get_cache_dir(os.path.dirname(country_dir), data_gen, basin_f)
+        files_states = {src: files for src, files in basin_files['sources'].items() if len(files) > 0}
+        # None for the sources that must be reduced again
+        with stage_timer(record, 'cache'):
+            source_manifests = {src: get_cached_source_manifest(cache_dir, src, files_state, data_gen, input_vars_repeated)
+                                for src, files_state in files_states.items()}
+        target_state = basin_files['target']
 
-            # Check whether there are files to load
-            if len(eras_files) == 0:
-                continue
-            
-            # Initialize an empty list to store the xarray datasets
-            datasets = []
-            # Iterate over the files and load each dataset
-            for file2load in eras_files:   ### [:5] for testing
-                
-                # If not .temp file
-                if '.tmp' not in file2load:
-                    
-                    # sys.stdout.write(f'\r>> {file2load}')
-                    # sys.stdout.flush()
-                    
-                    basin_data = xr.open_dataset(os.path.join(folder2load, file2load))
-                    datasets.append(basin_data)
-                
-            # Concatenate all datasets along the 'time' dimension
-            concatenated_dataset = xr.concat(datasets, dim='time')
-                
-            # Reduce basin_data to daily values
-            basin_data_reduced = reduceDataByDay(concatenated_dataset, data_gen['input_vars'], 
-                                                data_gen['sum_vars'], input_vars_repeated, src.lower())
-            # Convert the reduced basin_data to a DataFrame, dropping the 'hru' dimension
-            basin_data_df = basin_data_reduced.to_dataframe().droplevel('hru').reset_index()
-
-            print('basin_data_df', basin_data_df.head())
-           
-            # Save to dict
-            df_src_dict[src] = basin_data_df
-                  
-        
-        # # Check if only testing
-        # if ONLY_TESTING:
-        #     return None
-
-        print('basin', basin_f, '->', df_src_dict.keys())
-        # Check if there are len(data_sources) data sources in df_src_dict.keys() (expected ERA5, EM_EARTH, daymet, and RDRS)
-
-        # if len(df_src_dict.keys()) == len(data_sources):
-        #     # Merge dataframes in the dictionary
-        #     df_merged_inp = df_src_dict[data_sources[0]].merge(df_src_dict[data_sources[1]], on='time')
-        # elif len(df_src_dict.keys()) == 1:
-        #     df_merged_inp = df_src_dict[list(df_src_dict.keys())[0]]
-
-        if len(df_src_dict.keys()) == len(data_sources):
-            # Dynamically merge all dataframes in the dictionary based on the 'time' column using an outer join
-            df_merged_inp = reduce(lambda left, right: pd.merge(left, right, on='time', how='outer'), 
-                                [df_src_dict[src] for src in data_sources])
-        elif len(df_src_dict.keys()) == 1:
-            df_merged_inp = df_src_dict[list(df_src_dict.keys())[0]]
-        else:
-            raise ValueError("The number of data sources does not match the keys in the dictionary.")
-                        
-        # Rename time by date
-        df_merged_inp.rename(columns={'time': 'date'}, inplace=True)
-
-        # print('df_merged_inp', df_merged_inp.head())
-        # # Print data_vars
-        # for var in df_merged_inp.columns:
-        #     print(var)
-        #     if var not in data_gen['input_vars']:
-        #         print('Variable not in inputs:', var)
-        # aux = input('Enter to continue')
-        
-        ## Load target data
-        target_data = xr.open_dataset(os.path.join(basin_data_path, basin_f, relative_path_targ, 
-                                                f'{basin_f}_daily_flow_observations.nc'))
-        
+    if os.path.exists(csv_file_path):
+        if not use_cache:
+            return 'skipped', None
+        cached_manifest = read_manifest(os.path.join(cache_dir, 'basin.json'))
+        if cached_manifest is None:
+            print(f"No manifest for {basin_f}, keeping the existing file")
+            return 'skipped', None
+        if (all(manifest is not None for manifest in source_manifests.values()) and 
+            cached_manifest['key'] == get_basin_manifest(source_manifests, target_state, data_gen)['key']):
+            print(f"{basin_f} is up to date")
+            return 'up_to_date', None
+        print(f"Inputs or settings of {basin_f} changed, updating...")
+
+    vprint('\n', basin_f[:3], '->', basin_id)
+    for src in data_sources:
+        vprint(f'{src}_files', len(source_files[src]), '->', folder2load)
+    # Sources with files to load
+    sources = [src for src in data_sources if len(source_files[src]) > 0]
+
+    def load_source(src):
+        return loadSourceByDay(folder2load, source_files[src], src, data_gen, input_vars_repeated,
+                               cache_dir=cache_dir if use_cache else None, 
+                               source_manifest=source_manifests[src] if use_cache else None,
+                               files_state=files_states[src] if use_cache else None,
+                               source_record=get_source_record(record, src))
+
+    # Read the sources of the basin concurrently (I/O bound: the threads mostly wait on the file system)
+    source_threads = min(data_gen.get('source_threads', 1), len(sources))
+    if source_threads > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=source_threads) as executor:
+            source_results = dict(zip(sources, executor.map(load_source, sources)))
+    else:
+        source_results = {src: load_source(src) for src in sources}
+
+    df_src_dict = {}
+    for src in sources:
+        # Save to dict
+        df_src_dict[src], manifest = source_results[src]
+        if use_cache:
+            source_manifests[src] = manifest
+
+    # # Check if only testing
+    # if ONLY_TESTING:
+    #     return None
+
+    vprint('basin', basin_f, '->', df_src_dict.keys())
+    # Check if there are len(data_sources) data sources in df_src_dict.keys() (expected ERA5, EM_EARTH, daymet, and RDRS)
+
+    # if len(df_src_dict.keys()) == len(data_sources):
+    #     # Merge dataframes in the dictionary
+    #     df_merged_inp = df_src_dict[data_sources[0]].merge(df_src_dict[data_sources[1]], on='time')
+    # elif len(df_src_dict.keys()) == 1:
+    #     df_merged_inp = df_src_dict[list(df_src_dict.keys())[0]]
+
+    if len(df_src_dict.keys()) != len(data_sources) and len(df_src_dict.keys()) != 1:
+        raise ValueError("The number of data sources does not match the keys in the dictionary.")
+    
+    ## Load target data
+    with stage_timer(record, 'target'), NETCDF_LOCK, xr.open_dataset(target_file) as target_data:
+    
         # Subset by data_gen['target_vars']
         target_data = target_data[data_gen['target_vars']]
         # Convert to DataFrame
         df_target = target_data.to_dataframe().reset_index()
-        # Rename time by date
-        df_target.rename(columns={'time': 'date'}, inplace=True)
-        # Remove duplicates
-        df_target = df_target.drop_duplicates(subset=['date'])
-
-        # print('df_target', df_target.head())
-        
-        # Merge input and target dataframes
-        df_merged = df_merged_inp.merge(df_target, on='date')
-
+        # Same precision as the sources
+        float_cols = df_target.select_dtypes('floating').columns
+        df_target[float_cols] = df_target[float_cols].astype(data_gen.get('float_precision', 'float64'))
 
-        # print('df_merged', df_merged.head())
-        # # Print data_vars
-        # for var in df_merged.columns:
-        #     print(var)
-        #     if var not in data_gen['input_vars']:
-        #         print('Variable not in inputs:', var)
-        # aux = input('Enter to continue')
-        
-        # Save to file
-        # print("Saving to file...", os.path.join(country_dir, basin_id + '.csv'))
-        # df_merged.to_csv(os.path.join(country_dir, basin_f[4:] + '.csv'), index=False)
-        print("Saving to file...", csv_file_path)
-        df_merged.to_csv(csv_file_path, index=False)
-
-def get_cyril_basins():
-
-    # Load cyril basins from data / liste_BV_CAMELS-spat_928.txt
-    cyril_file = os.path.join(ROOT_DIR, 'data', 'liste_BV_CAMELS-spat_928.txt')
-    with open(cyril_file, 'r') as f:
-        cyril_list = f.readlines()
-    # Remove 'XXX_' from the beginning of each line
-    cyril_list = [line[4:].strip() for line in cyril_list]
-    return cyril_list
+    # print('df_target', df_target.head())
+    
+    # Align the sources (outer join on the days) and the target (inner join, without duplicated days) on one date index
+    with stage_timer(record, 'merge'):
+        df_merged = merge_basin_frames([df_src_dict[src] for src in data_sources if src in df_src_dict], df_target)
+
+    # print('df_merged', df_merged.head())
+    # # Print data_vars
+    # for var in df_merged.columns:
+    #     print(var)
+    #     if var not in data_gen['input_vars']:
+    #         print('Variable not in inputs:', var)
+    # aux = input('Enter to continue')
+    
+    # Save to file
+    # print("Saving to file...", os.path.join(country_dir, basin_id + '.csv'))
+    # df_merged.to_csv(os.path.join(country_dir, basin_f[4:] + '.csv'), index=False)
+    print("Saving to file...", csv_file_path)
+    manifest_args = ()
+    if use_cache:
+        manifest_args = (os.path.join(cache_dir, 'basin.json'), get_basin_manifest(source_manifests, target_state, data_gen))
+    if on_written is not None:
+        queue_write(save_basin_output, df_merged, on_written, csv_file_path, output_format, record, *manifest_args)
+        return 'queued', df_merged
+    save_basin_output(df_merged, csv_file_path, output_format, record, *manifest_args)
+
+    return 'done', df_merged
+
+def save_basin_output(df_merged, csv_file_path, output_format, record=None, manifest_path=None, manifest=None):
+    '''
+    Write a converted basin with its summary sidecar and its cache manifest (run by a writer thread when queued)
+    Args:
+        df_merged: pandas.DataFrame, converted basin data with a 'date' column
+        csv_file_path: str, path to the output file
+        output_format: str, one of BASIN_WRITERS
+        record: dict, profiling record of the basin, optional
+        manifest_path: str, path to the basin manifest of the cache (no manifest if None)
+        manifest: dict, basin manifest (see get_basin_manifest)
+    '''
+    with stage_timer(record, 'write'):
+        # The netCDF libraries are not thread safe (see NETCDF_LOCK)
+        with NETCDF_LOCK if output_format == 'netcdf' else contextlib.nullcontext():
+            write_basin(df_merged, csv_file_path, output_format)
+        # Date range, row count, NaN counts and value ranges, for the statistics of the outputs
+        write_basin_summary(csv_file_path, summarize_basin_frame(df_merged))
+        if manifest_path is not None:
+            write_manifest(manifest_path, manifest)
+
+def loadSourceByDay(folder2load, eras_files, src, data_gen, input_vars_repeated, 
+                    cache_dir=None, source_manifest=None, files_state=None, source_record=None):
+    '''
+    Get the daily DataFrame of a data source, from the cache if it is up to date or by reducing its files
+    Args:
+        folder2load: str, path to the forcing folder of the basin
+        eras_files: list, sorted forcing file names of the source
+        src: str, data source name
+        data_gen: dict, data from data_general.yml
+        input_vars_repeated: set, variables that appear repeatedly
+        cache_dir: str, path to the basin cache folder (no cache if None)
+        source_manifest: dict, manifest of the cached source (None if it must be reduced again)
+        files_state: list, [name, size, mtime_ns] of the source files
+        source_record: dict, profiling counters of the source, optional
+    Returns:
+        basin_data_df: pandas.DataFrame, daily values with a 'time' column
+        source_manifest: dict, manifest of the source (None without cache)
+    '''
+    if cache_dir is not None and source_manifest is not None:
+        with stage_timer(source_record, 'cache'):
+            basin_data_df = load_cached_source(cache_dir, src)
+        source_record is not None and source_record.update(cached=True)
+        vprint(f'{src} loaded from cache')
+    else:
+        basin_data_df = reduceSourceByDay(folder2load, eras_files, src, data_gen, input_vars_repeated, source_record)
+        if cache_dir is not None:
+            with stage_timer(source_record, 'cache'):
+                source_manifest = get_source_manifest(files_state, src, get_source_variables(folder2load, eras_files[0]), 
+                                                      data_gen, input_vars_repeated)
+                save_cached_source(cache_dir, src, source_manifest, basin_data_df)
+
+    vprint('basin_data_df', basin_data_df.head())
+    return basin_data_df, source_manifest
+
+def reduceSourceByDay(folder2load, eras_files, src, data_gen, input_vars_repeated, source_record=None):
+    '''
+    Load the forcing files of a data source and reduce them to a daily DataFrame
+    Daily sources (see get_source_steps_per_day) are not reduced, their values are read straight into columns
+    Args:
+        folder2load: str, path to the forcing folder of the basin
+        eras_files: list, sorted forcing file names of the source
+        src: str, data source name
+        data_gen: dict, data from data_general.yml
+        input_vars_repeated: set, variables that appear repeatedly
+        source_record: dict, profiling counters of the source, optional
+    Returns:
+        basin_data_df: pandas.DataFrame, daily values with a 'time' column
+    '''
+    dtype = data_gen.get('float_precision', 'float64')
+    steps_per_day = get_source_steps_per_day(src, os.path.join(folder2load, eras_files[0]), data_gen)
+
+    if steps_per_day == 1:
+        # Daily source (daymet): no aggregation, the values are read straight into columns
+        datasets = list(iter_forcing_files(folder2load, eras_files, source_record, data_gen.get('prefetch_files', 0)))
+        with stage_timer(source_record, 'reduce'):
+            basin_data_df = daily_files_to_frame(datasets, data_gen['input_vars'], data_gen['sum_vars'],
+                                                 input_vars_repeated, src.lower(), dtype)
+            if basin_data_df is not None:
+                return basin_data_df
+            # Not a lumped series with one value per day: reduce the files as an hourly source
+            basin_data_reduced = reduce_files_by_day(datasets, data_gen['input_vars'], data_gen['sum_vars'],
+                                                     input_vars_repeated, src.lower(), dtype)
+    else:
+        # Hourly source: reduce the files one by one, only the daily values are kept in memory
+        reduce_start = time.perf_counter()
+        open_time = source_record['stages'].get('open', 0.0) if source_record is not None else 0.0
+        forcing_files = iter_forcing_files(folder2load, eras_files, source_record, data_gen.get('prefetch_files', 0))
+        basin_data_reduced = reduce_files_by_day(forcing_files, data_gen['input_vars'], data_gen['sum_vars'], 
+                                                 input_vars_repeated, src.lower(), dtype, steps_per_day)
+        # Reading is interleaved with the reduction, keep them apart
+        if source_record is not None:
+            open_time = source_record['stages'].get('open', 0.0) - open_time
+            add_time(source_record, 'reduce', time.perf_counter() - reduce_start - open_time)
+
+    # Convert the reduced basin_data to a DataFrame, dropping the 'hru' dimension
+    with stage_timer(source_record, 'reduce'):
+        return basin_data_reduced.to_dataframe().droplevel('hru').reset_index()
 
 if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert CAMELS-spat basins to NeuralHydrology input files')
+    parser.add_argument('--multiprocessing', action=argparse.BooleanOptionalAction, default=bool(MULTIPROCESSING),
+                        help='process the basins in parallel with a process pool')
+    parser.add_argument('--max-workers', type=int, default=MAX_WORKERS,
+                        help='number of worker processes (default: SLURM_CPUS_PER_TASK or 32)')
+    parser.add_argument('--shard-index', type=int, default=SHARD_INDEX,
+                        help='index of the basin shard to process (default: from SLURM_ARRAY_TASK_ID)')
+    parser.add_argument('--shard-count', type=int, default=SHARD_COUNT,
+                        help='number of basin shards (default: SLURM_ARRAY_TASK_COUNT or 1)')
+    parser.add_argument('--output-format', choices=list(BASIN_WRITERS), default=None,
+                        help='format of the basin output files (default: output_format in data_general.yml, or csv)')
+    parser.add_argument('--incremental-cache', action=argparse.BooleanOptionalAction, default=None,
+                        help='reuse cached daily sources and only rebuild basins whose inputs or settings changed')
+    parser.add_argument('--consolidated-store', choices=['none', 'country', 'all'], default=None,
+                        help='also write the basins to one (basin, date) store per country or for all countries')
+    parser.add_argument('--consolidate', action='store_true',
+                        help='only add the existing basin output files to the consolidated store')
+    parser.add_argument('--verify', action='store_true',
+                        help='only check that every expected basin was produced exactly once by the shards')
+    parser.add_argument('--reuse-index', action=argparse.BooleanOptionalAction, default=None,
+                        help='reload the saved basin index instead of scanning the basin folders again')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the basins finished according to the run journal, convert the interrupted or failed ones again')
+    parser.add_argument('--scan-only', action='store_true',
+                        help='only scan the basin folders and save the basin index (e.g. before a job array)')
+    parser.add_argument('--profile', action=argparse.BooleanOptionalAction, default=None,
+                        help='record the time of each stage per basin and print a summary at the end')
+    parser.add_argument('--cprofile', action='store_true',
+                        help='also dump cProfile stats of each basin to the profiling folder')
+    parser.add_argument('--verbose', action='store_true',
+                        help='print detailed progress messages (file lists, head of each source)')
+    args = parser.parse_args()
+    if not 0 <= args.shard_index < args.shard_count:
+        parser.error(f'--shard-index must be in [0, {args.shard_count - 1}]')
     
     # Load data
     data_dir, data_gen = load_util_data(ROOT_DIR)
     
+    if args.output_format is not None:
+        data_gen['output_format'] = args.output_format
+    if args.incremental_cache is not None:
+        data_gen['incremental_cache'] = args.incremental_cache
+    if args.consolidated_store is not None:
+        data_gen['consolidated_store'] = args.consolidated_store
+    if args.reuse_index is not None:
+        data_gen['reuse_basin_index'] = args.reuse_index
+    if args.profile is not None:
+        data_gen['profiling'] = args.profile
+    data_gen['cprofile'] = args.cprofile
+    data_gen['resume'] = args.resume
+    data_gen['verbose'] = args.verbose
+    set_verbose(args.verbose)
+    
     # Load Unusable basins
     unusuable_basins = get_unusable_basins(data_dir['data_dir_camels_spat_nh'], data_gen['camels_spat_unusable'])
 
     print('Unusable basins:', len(unusuable_basins))
     print(unusuable_basins)
 
+    if args.scan_only:
+        get_basin_index(data_dir, data_gen)
+        sys.exit(0)
+
+    if args.verify:
+        sys.exit(0 if verify_outputs(data_dir, data_gen, unusuable_basins, args.shard_count) else 1)
+
+    if args.consolidate:
+        basin_index = get_basin_index(data_dir, data_gen, reuse=data_gen.get('reuse_basin_index', False))
+        consolidate_outputs(data_dir['data_dir_camels_spat_nh'], data_gen, unusuable_basins, 
+                            list(get_selected_basins(data_dir, data_gen, basin_index)['basin_f']))
+        sys.exit(0)
+
     ## Let's profile the loop
     start_time = time.time()
-    camels_spat2nh(data_dir, data_gen, unusuable_basins)
+    camels_spat2nh(data_dir, data_gen, unusuable_basins, 
+                   multiprocessing=args.multiprocessing, max_workers=args.max_workers,
+                   shard_index=args.shard_index, shard_count=args.shard_count)
     ## End of process
     print('\n', f"--- {(time.time() - start_time):.2f} seconds ---")
     
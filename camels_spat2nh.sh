@@ -8,10 +8,22 @@
 #SBATCH --mem=64G
 #SBATCH --output=camels_spat2nh-%j.out
 #SBATCH --error=camels_spat2nh-%j.err
+# To split the basins across nodes, scan the basin folders once and submit as a job array
+# (each task reloads the index with --reuse-index and takes one shard), e.g.
+#   python3 camels_spat2nh.py --scan-only && sbatch --array=0-3 camels_spat2nh.sh
+# and check the outputs once all tasks are done with
+#   python3 camels_spat2nh.py --verify --shard-count 4
+# A killed or failed task can be resubmitted with --resume (only its unfinished and failed basins are converted)
  
 module load python/3.11.5
 
 # Path to your virtual environment's activation script
 source venv-camelsspat/bin/activate
  
-python3 camels_spat2nh.py
+# Only the tasks of a job array reload the index written by --scan-only, a single job scans the basins
+REUSE_INDEX=""
+if [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+    REUSE_INDEX="--reuse-index"
+fi
+
+python3 camels_spat2nh.py --multiprocessing --max-workers $SLURM_CPUS_PER_TASK $REUSE_INDEX
@@ -1,37 +1,230 @@
 import os
+import re
 import sys
+import shutil
+import argparse
 import pandas as pd
 from pathlib import Path
 
 from utils.utils import load_util_data, get_unusable_basins
+from utils.writers import OUTPUT_EXTENSIONS
+from utils.cache import get_cache_dir, get_files_state, hash_config, read_manifest, write_manifest
+from camels_spat2nh import get_country_dir, list_output_files
 
 # Get the root directory of the project with Path
 ROOT_DIR = Path(__file__).resolve().parents[0]
 
+# Columns identifying the basins when the attribute file has one row per basin
+ID_COLUMNS = ['Country', 'Station_id']
+# Basin columns when the attribute file has one row per attribute (e.g. 'CAN_01AD002')
+BASIN_COLUMN = re.compile(r'^[A-Z]{3}_\S+$')
+# Folder of the attribute files, inside each country output folder
+ATTRIBUTES_DIR = 'attributes'
+
+def get_attribute_names(descriptions):
+    '''
+    Name the attributes of a file with one row per attribute
+    Attributes with the same name (e.g. from several sources) are suffixed with their source
+    Args:
+        descriptions: pandas.DataFrame, description columns of the attribute rows (e.g. category, attribute, unit, source)
+    Returns:
+        names: pandas.Series, unique attribute names
+    '''
+    columns = {col.lower(): col for col in descriptions.columns}
+    names = descriptions[columns.get('attribute', descriptions.columns[-1])].astype(str)
+    duplicated = names.duplicated(keep=False)
+    if duplicated.any():
+        suffix = descriptions[columns['source']].astype(str) if 'source' in columns else pd.Series(range(len(names)), index=names.index).astype(str)
+        names = names.where(~duplicated, names + '_' + suffix.str.replace(r'\W+', '_', regex=True))
+    return names
+
+def read_attributes(attributes_file, basins, attributes=None):
+    '''
+    Read the static attributes of some basins, parsing only the needed columns
+    The file may have one row per basin ('Country', 'Station_id' and one column per attribute) or one row
+    per attribute (description columns and one column per basin, e.g. 'CAN_01AD002')
+    Args:
+        attributes_file: str, path to camels_spat_attributes.csv
+        basins: list, basin folder names (e.g. 'USA_01013500')
+        attributes: list, attributes to read (all if None)
+    Returns:
+        df: pandas.DataFrame, attributes indexed by basin folder name (not yet converted to numbers)
+    '''
+    header = pd.read_csv(attributes_file, nrows=0).columns
+    if all(col in header for col in ID_COLUMNS):
+        # One row per basin: read the id and attribute columns only
+        keep = set(ID_COLUMNS) | set(attributes) if attributes else None
+        df = pd.read_csv(attributes_file, usecols=(lambda col: col in keep) if keep else None,
+                         dtype={col: str for col in ID_COLUMNS})
+        df.index = pd.Index(df['Country'] + '_' + df['Station_id'], name='basin')
+        df = df.drop(columns=ID_COLUMNS)
+        return df[~df.index.duplicated()]
+
+    # One row per attribute: read the description columns and the columns of the basins only
+    basin_set = set(basins)
+    descriptions = [col for col in header if not BASIN_COLUMN.match(col)]
+    df = pd.read_csv(attributes_file, usecols=lambda col: col in basin_set or not BASIN_COLUMN.match(col), dtype=str)
+    df.index = get_attribute_names(df[descriptions])
+    df = df.drop(columns=descriptions)
+    if attributes:
+        df = df[df.index.isin(attributes)]
+    df = df.T
+    df.index.name = 'basin'
+    df.columns.name = None
+    return df
+
+def to_numeric_attributes(df):
+    '''
+    Keep the numeric attributes (NeuralHydrology only takes numbers), as float64
+    Args:
+        df: pandas.DataFrame, attributes indexed by basin
+    Returns:
+        df: pandas.DataFrame, numeric attributes
+        dropped: list, attributes left out because none of their values is a number
+    '''
+    numeric = df.apply(pd.to_numeric, errors='coerce').astype('float64')
+    dropped = [col for col in df.columns if numeric[col].isna().all() and df[col].notna().any()]
+    return numeric.drop(columns=dropped), dropped
+
+def write_attribute_files(df, attributes_dir, attribute_formats):
+    '''
+    Write the attributes of a country in each format (through temporary files, as the basin outputs)
+    Args:
+        df: pandas.DataFrame, attributes indexed by 'gauge_id'
+        attributes_dir: str, path to the attributes folder of the country
+        attribute_formats: list, formats of OUTPUT_EXTENSIONS to write
+    Returns:
+        written: list, formats written (the formats whose library is missing are skipped)
+    '''
+    os.makedirs(attributes_dir, exist_ok=True)
+    written = []
+    for attribute_format in attribute_formats:
+        file_path = os.path.join(attributes_dir, 'attributes' + OUTPUT_EXTENSIONS[attribute_format])
+        tmp_path = file_path + '.tmp'
+        try:
+            if attribute_format == 'csv':
+                df.to_csv(tmp_path)
+            elif attribute_format == 'parquet':
+                df.to_parquet(tmp_path)
+            elif attribute_format == 'feather':
+                df.reset_index().to_feather(tmp_path)
+            elif attribute_format == 'netcdf':
+                df.to_xarray().to_netcdf(tmp_path)
+            os.replace(tmp_path, file_path)
+            written.append(attribute_format)
+        except ImportError as e:
+            # parquet and feather require pyarrow
+            print(f"Skipping the {attribute_format} attributes: {e}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return written
+
+def get_converted_basins(data_dir_out, data_gen, unusuable_basins):
+    '''
+    List the converted basins of each country, in the order of their output files
+    Args:
+        data_dir_out: str, path to the output directory
+        data_gen: dict, data from data_general.yml
+        unusuable_basins: set, unusable basins
+    Returns:
+        basins: dict, country -> sorted basin folder names with an output file
+    '''
+    extension = OUTPUT_EXTENSIONS[data_gen.get('output_format', 'csv')]
+    output_files = list_output_files(data_dir_out, data_gen['countries'], len(data_gen['data_sources']))
+    return {country: sorted(f'{country}_{file_name[:-len(extension)]}' for file_name in file_names
+                            if file_name.endswith(extension) and file_name[:-len(extension)] not in unusuable_basins)
+            for country, file_names in output_files.items()}
+
+def export_attributes(data_dir, data_gen, unusuable_basins, force=False):
+    '''
+    Write the static attributes of the converted basins of each country to {country folder}/attributes/,
+    joined with metadata columns, as NeuralHydrology attribute files (indexed by 'gauge_id')
+    A country is only exported again if its basins, the input files or the settings changed
+    Args:
+        data_dir: dict, data from data_dir.yml
+        data_gen: dict, data from data_general.yml
+        unusuable_basins: set, unusable basins
+        force: bool, whether to export all the countries even if they are up to date
+    '''
+    data_dir_out = data_dir['data_dir_camels_spat_nh']
+    n_sources = len(data_gen['data_sources'])
+    attributes_file = os.path.join(data_dir['data_dir_camels_spat'], data_gen.get('camels_spat_attributes', 'camels_spat_attributes.csv'))
+    metadata_file = os.path.join(ROOT_DIR, 'data', data_gen['camels_spat_metadata'])
+    attribute_formats = data_gen.get('attribute_formats', ['csv', 'parquet'])
+    static_attributes = data_gen.get('static_attributes') or None
+    metadata_columns = data_gen.get('attribute_metadata_columns') or []
+    cache_dir = get_cache_dir(data_dir_out, data_gen, ATTRIBUTES_DIR)
+
+    # Copy the attribute file to ROOT_DIR / 'data' (kept for the notebooks), unless it is up to date
+    attributes_copy = os.path.join(ROOT_DIR, 'data', os.path.basename(attributes_file))
+    source_stat = os.stat(attributes_file)
+    copy_stat = os.stat(attributes_copy) if os.path.exists(attributes_copy) else None
+    if copy_stat is None or (source_stat.st_size, source_stat.st_mtime_ns) != (copy_stat.st_size, copy_stat.st_mtime_ns):
+        shutil.copy2(attributes_file, attributes_copy)
+
+    # Manifest of the inputs and settings of each country
+    inputs_state = {'attributes': get_files_state(os.path.dirname(attributes_file), [os.path.basename(attributes_file)]),
+                    'metadata': get_files_state(os.path.dirname(metadata_file), [os.path.basename(metadata_file)])}
+    config = {'static_attributes': static_attributes, 'attribute_metadata_columns': metadata_columns,
+              'attribute_formats': attribute_formats}
+    basins = get_converted_basins(data_dir_out, data_gen, unusuable_basins)
+
+    manifests = {}
+    for country in data_gen['countries']:
+        attributes_dir = os.path.join(get_country_dir(data_dir_out, country, n_sources), ATTRIBUTES_DIR)
+        manifest = {'inputs': inputs_state, 'basins': basins[country], 'config': config}
+        manifest['key'] = hash_config(manifest)
+        cached_manifest = read_manifest(os.path.join(cache_dir, f'{country}.json'))
+        # Only the formats written by the last export (a format whose library is missing is skipped every time)
+        outputs_exist = cached_manifest is not None and all(
+            os.path.exists(os.path.join(attributes_dir, 'attributes' + OUTPUT_EXTENSIONS[attribute_format]))
+            for attribute_format in cached_manifest.get('written', attribute_formats))
+        if not force and outputs_exist and cached_manifest['key'] == manifest['key']:
+            print(f"{country} attributes are up to date")
+            continue
+        if len(basins[country]) == 0:
+            print(f"No converted basins for {country}")
+            continue
+        manifests[country] = manifest
+
+    if len(manifests) == 0:
+        return
+
+    # One typed read of the attribute file for all the countries to export
+    df = read_attributes(attributes_file, [basin_f for country in manifests for basin_f in basins[country]], static_attributes)
+    if metadata_columns:
+        metadata = pd.read_csv(metadata_file, usecols=ID_COLUMNS + metadata_columns, dtype={col: str for col in ID_COLUMNS})
+        metadata.index = metadata['Country'] + '_' + metadata['Station_id']
+        df = df.join(metadata.loc[~metadata.index.duplicated(), metadata_columns], how='outer', rsuffix='_metadata')
+    df, dropped = to_numeric_attributes(df)
+    if dropped:
+        print(f"Non-numeric attributes left out: {dropped}")
+
+    for country, manifest in manifests.items():
+        # Same basins and order as the time series, indexed by their file name
+        df_country = df.reindex(basins[country])
+        missing = df_country.index[df_country.isna().all(axis=1)]
+        if len(missing) > 0:
+            print(f"{len(missing)} {country} basins without attributes: {list(missing[:10])}")
+        df_country.index = pd.Index([basin_f[4:] for basin_f in basins[country]], name='gauge_id')
+
+        attributes_dir = os.path.join(get_country_dir(data_dir_out, country, n_sources), ATTRIBUTES_DIR)
+        print(f"Writing {df_country.shape[1]} attributes of {len(df_country)} {country} basins to {attributes_dir}")
+        manifest['written'] = write_attribute_files(df_country, attributes_dir, attribute_formats)
+        write_manifest(os.path.join(cache_dir, f'{country}.json'), manifest)
+
 if __name__ == '__main__':
-    
-    print(ROOT_DIR)
-    print(os.listdir(ROOT_DIR))
+
+    parser = argparse.ArgumentParser(description='Export the static attributes of the converted CAMELS-spat basins')
+    parser.add_argument('--force', action='store_true',
+                        help='export the attributes of all the countries, even if they are up to date')
+    args = parser.parse_args()
 
     # camels_spat2nh()
     data_dir, data_gen = load_util_data(str(ROOT_DIR))
-    
+
     # Load Unusable basins
     unusuable_basins = get_unusable_basins(data_dir['data_dir_camels_spat_nh'], data_gen['camels_spat_unusable'])
 
-    # # Load files in data_dir['data_dir_camels_spat'] / 'attributes'
-    # attributes_dir = Path(data_dir['data_dir_camels_spat']) / 'attributes'
-
-    # # Loas 1st file in attributes_dir
-    # file = sorted(os.listdir(attributes_dir))[0]
-    # df = pd.read_csv(attributes_dir / file)
-    # print(df.head())
-
-    att_file_dir = Path(data_dir['data_dir_camels_spat']) / 'camels_spat_attributes.csv'
-    df = pd.read_csv(att_file_dir)
-    print(df.head())
-
-    # Copy attribute file to ROOT_DIR / 'data'
-    att_file_dir_out = ROOT_DIR / 'data' / 'camels_spat_attributes.csv'
-    df.to_csv(att_file_dir_out, index=False)
-    
\ No newline at end of file
+    export_attributes(data_dir, data_gen, unusuable_basins, force=args.force)
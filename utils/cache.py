@@ -0,0 +1,181 @@
+import os
+import json
+import hashlib
+import xarray as xr
+import pandas as pd
+
+from utils.utils import NETCDF_LOCK
+
+
+# Bump when the daily reduction changes, so that cached sources are recomputed
+REDUCER_VERSION = 2
+
+def hash_config(config):
+    '''
+    Hash a JSON-serializable configuration
+    Args:
+        config: dict, configuration to hash
+    Returns:
+        key: str, sha256 hex digest of the sorted JSON dump
+    '''
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+def get_cache_dir(data_dir_out, data_gen, basin_f):
+    '''
+    Get the cache folder of a basin
+    Args:
+        data_dir_out: str, path to the output directory
+        data_gen: dict, data from data_general.yml
+        basin_f: str, basin folder name (e.g. 'USA_01013500')
+    Returns:
+        cache_dir: str, path to the basin cache folder
+    '''
+    return os.path.join(data_gen.get('cache_dir') or os.path.join(data_dir_out, 'cache'), basin_f)
+
+def get_files_state(folder, files):
+    '''
+    Record the name, size and modification time of input files
+    Args:
+        folder: str, path to the folder of the files
+        files: list, file names
+    Returns:
+        files_state: list, [name, size, mtime_ns] of each file
+    '''
+    files_state = []
+    for file in files:
+        stat = os.stat(os.path.join(folder, file))
+        files_state.append([file, stat.st_size, stat.st_mtime_ns])
+    return files_state
+
+def get_source_variables(folder, file):
+    '''
+    List the data variables of a source from one of its files (metadata only)
+    Args:
+        folder: str, path to the folder of the file
+        file: str, file name
+    Returns:
+        variables: list, data variables of the file
+    '''
+    with NETCDF_LOCK, xr.open_dataset(os.path.join(folder, file)) as ds:
+        return list(ds.data_vars)
+
+def get_source_manifest(files_state, src, variables, data_gen, input_vars_repeated):
+    '''
+    Build the manifest of a reduced source: input files and the reduction settings of its variables
+    Only the settings of the source's own variables are hashed, so that editing the variables
+    of one source does not invalidate the others
+    Args:
+        files_state: list, [name, size, mtime_ns] of the source files
+        src: str, data source name
+        variables: list, data variables of the source files
+        data_gen: dict, data from data_general.yml
+        input_vars_repeated: set, variables that appear repeatedly
+    Returns:
+        manifest: dict, manifest with its 'key'
+    '''
+    config = {
+        'source': src,
+        # [averaged, summed, suffixed with the source name] for each variable
+        'reduction': {var: [var in data_gen['input_vars'], var in data_gen['sum_vars'], var in input_vars_repeated] 
+                      for var in variables},
+        'reducer_version': REDUCER_VERSION,
+    }
+    # Only hashed when not the default, so that float64 caches stay valid
+    if data_gen.get('float_precision', 'float64') != 'float64':
+        config['float_precision'] = data_gen['float_precision']
+    manifest = {'files': files_state, 'variables': variables, 'config': config}
+    manifest['key'] = hash_config(manifest)
+    return manifest
+
+def get_cached_source_manifest(cache_dir, src, files_state, data_gen, input_vars_repeated):
+    '''
+    Get the manifest of a cached source if its input files and reduction settings did not change
+    Args:
+        cache_dir: str, path to the basin cache folder
+        src: str, data source name
+        files_state: list, [name, size, mtime_ns] of the source files
+        data_gen: dict, data from data_general.yml
+        input_vars_repeated: set, variables that appear repeatedly
+    Returns:
+        manifest: dict, current manifest of the source (None if the cache is missing or stale)
+    '''
+    cached_manifest = read_manifest(os.path.join(cache_dir, f'{src}.json'))
+    if cached_manifest is None or cached_manifest.get('files') != files_state:
+        return None
+    if not os.path.exists(os.path.join(cache_dir, f'{src}.pkl')):
+        return None
+    manifest = get_source_manifest(files_state, src, cached_manifest['variables'], data_gen, input_vars_repeated)
+    return manifest if manifest['key'] == cached_manifest['key'] else None
+
+def get_basin_manifest(source_manifests, target_state, data_gen):
+    '''
+    Build the manifest of a basin output: its sources, target file and merge settings
+    Args:
+        source_manifests: dict, manifest of each data source
+        target_state: list, [name, size, mtime_ns] of the target file
+        data_gen: dict, data from data_general.yml
+    Returns:
+        manifest: dict, manifest with its 'key'
+    '''
+    config = {
+        'data_sources': data_gen['data_sources'],
+        'target_vars': data_gen['target_vars'],
+        'output_format': data_gen.get('output_format', 'csv'),
+    }
+    manifest = {'sources': {src: source_manifest['key'] for src, source_manifest in source_manifests.items()},
+                'target': target_state, 'config': config}
+    manifest['key'] = hash_config(manifest)
+    return manifest
+
+def read_manifest(manifest_path):
+    '''
+    Read a manifest file
+    Args:
+        manifest_path: str, path to the JSON manifest
+    Returns:
+        manifest: dict, manifest (None if missing or unreadable)
+    '''
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_manifest(manifest_path, manifest):
+    '''
+    Write a manifest file (through a temporary file, so it is never left half written)
+    Args:
+        manifest_path: str, path to the JSON manifest
+        manifest: dict, manifest to write
+    '''
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+def load_cached_source(cache_dir, src):
+    '''
+    Load the cached daily frame of a source
+    Args:
+        cache_dir: str, path to the basin cache folder
+        src: str, data source name
+    Returns:
+        df: pandas.DataFrame, cached daily frame
+    '''
+    return pd.read_pickle(os.path.join(cache_dir, f'{src}.pkl'))
+
+def save_cached_source(cache_dir, src, manifest, df):
+    '''
+    Cache the daily frame of a source with its manifest
+    Args:
+        cache_dir: str, path to the basin cache folder
+        src: str, data source name
+        manifest: dict, manifest of the source
+        df: pandas.DataFrame, daily frame of the source
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    frame_path = os.path.join(cache_dir, f'{src}.pkl')
+    df.to_pickle(frame_path + '.tmp')
+    os.replace(frame_path + '.tmp', frame_path)
+    write_manifest(os.path.join(cache_dir, f'{src}.json'), manifest)
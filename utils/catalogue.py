@@ -0,0 +1,123 @@
+import os
+
+import pandas as pd
+
+from utils.discovery import get_basin_cost
+
+
+def read_basin_list(file_path):
+    '''
+    Read a list of basins: one basin per line ('XXX_id' or id) in a text file, or the first column of a csv
+    USGS ids stored as integers (e.g. 2324400 in the worst-basins lists) get their leading zeros back
+    Args:
+        file_path: str, path to the list
+    Returns:
+        basins: set, basin folder names ('XXX_id') or station ids
+    '''
+    if file_path.endswith('.csv'):
+        values = pd.read_csv(file_path, dtype=str).iloc[:, 0]
+    else:
+        with open(file_path, 'r') as f:
+            values = pd.Series(f.read().split(), dtype=str)
+    values = values.str.strip()
+    # USGS station ids have 8 digits
+    return set(values.where(~values.str.fullmatch(r'\d{1,7}'), values.str.zfill(8)))
+
+def read_unusable_reasons(unusable_file):
+    '''
+    Read the reason why each unusable basin is left out (several reasons are joined with '; ')
+    Args:
+        unusable_file: str, path to camels_spat_unusable.csv
+    Returns:
+        reasons: pandas.DataFrame, 'country', 'station_id' and 'unusable_reason' columns
+    '''
+    df = pd.read_csv(unusable_file, dtype={'Station_id': str}, usecols=['Country', 'Station_id', 'Reason'])
+    df = df.rename(columns={'Country': 'country', 'Station_id': 'station_id', 'Reason': 'unusable_reason'})
+    return df.groupby(['country', 'station_id'], as_index=False)['unusable_reason'].agg('; '.join)
+
+def build_basin_catalogue(basin_index, metadata_file=None, unusable_file=None, basin_lists=None):
+    '''
+    Build the catalogue of the basins, keyed by (country, station_id): the basins of the index and of the
+    metadata, with their subset category, unusable reason, membership of the basin lists and cost
+    Args:
+        basin_index: dict, basin index (see build_basin_index)
+        metadata_file: str, path to camels_spat_metadata.csv (no subset categories if None or missing)
+        unusable_file: str, path to camels_spat_unusable.csv (no unusable reasons if None or missing)
+        basin_lists: dict, list name -> path to a basin list (see read_basin_list); missing lists are left out
+    Returns:
+        catalogue: pandas.DataFrame, sorted (country, station_id) index with the columns 'basin_f', 'on_disk',
+                   'cost' (bytes of forcing files), 'subset_category', 'unusable_reason' and 'in_{list name}'
+    '''
+    basin_fs = pd.Series(sorted(basin_index['basins']), dtype=str)
+    catalogue = pd.DataFrame({'country': basin_fs.str[:3], 'station_id': basin_fs.str[4:],
+                              'cost': [get_basin_cost(basin_index['basins'][basin_f]) for basin_f in basin_fs]})
+
+    if metadata_file is not None and os.path.exists(metadata_file):
+        metadata = pd.read_csv(metadata_file, dtype={'Station_id': str}, usecols=['Country', 'Station_id', 'subset_category'])
+        metadata = metadata.rename(columns={'Country': 'country', 'Station_id': 'station_id'})
+        catalogue = catalogue.merge(metadata.drop_duplicates(['country', 'station_id']), on=['country', 'station_id'], how='outer')
+    else:
+        catalogue['subset_category'] = None
+
+    if unusable_file is not None and os.path.exists(unusable_file):
+        catalogue = catalogue.merge(read_unusable_reasons(unusable_file), on=['country', 'station_id'], how='left')
+    else:
+        catalogue['unusable_reason'] = None
+
+    catalogue['basin_f'] = catalogue['country'] + '_' + catalogue['station_id']
+    catalogue['on_disk'] = catalogue['cost'].notna()
+    catalogue['cost'] = catalogue['cost'].fillna(0).astype('int64')
+    for name, list_file in (basin_lists or {}).items():
+        if not os.path.exists(list_file):
+            print(f"Warning: basin list '{name}' not found ({list_file}), check basin_lists in data_general.yml")
+            continue
+        basins = read_basin_list(list_file)
+        catalogue[f'in_{name}'] = catalogue['basin_f'].isin(basins) | catalogue['station_id'].isin(basins)
+
+    return catalogue.set_index(['country', 'station_id']).sort_index()
+
+def filter_basins(catalogue, countries=None, on_disk=True, exclude_unusable_reasons=None, subset_categories=None,
+                  in_lists=None, not_in_lists=None):
+    '''
+    Select basins of the catalogue (all the conditions are combined)
+    Args:
+        catalogue: pandas.DataFrame, basin catalogue (see build_basin_catalogue)
+        countries: list, country codes to keep (all if None)
+        on_disk: bool, whether to keep only the basins with a folder in basin_data
+        exclude_unusable_reasons: list, leave out the unusable basins whose reason contains one of these (case insensitive)
+        subset_categories: list, subset categories to keep (e.g. headwater, meso-scale, macro-scale; all if empty)
+        in_lists: list, names of the basin lists the basins must belong to (e.g. cyril)
+        not_in_lists: list, names of the basin lists the basins must not belong to (e.g. worst20_top50)
+    Returns:
+        selected: pandas.DataFrame, selected rows of the catalogue
+    '''
+    mask = pd.Series(True, index=catalogue.index)
+    if countries is not None:
+        mask &= catalogue.index.get_level_values('country').isin(countries)
+    if on_disk:
+        mask &= catalogue['on_disk']
+    for reason in exclude_unusable_reasons or []:
+        mask &= ~catalogue['unusable_reason'].fillna('').str.contains(reason, case=False, regex=False)
+    if subset_categories:
+        mask &= catalogue['subset_category'].isin(subset_categories)
+    for name in list(in_lists or []) + list(not_in_lists or []):
+        if f'in_{name}' not in catalogue.columns:
+            raise ValueError(f"Basin list '{name}' of basin_filters is not loaded, check basin_lists in data_general.yml")
+    for name in in_lists or []:
+        mask &= catalogue[f'in_{name}']
+    for name in not_in_lists or []:
+        mask &= ~catalogue[f'in_{name}']
+    return catalogue[mask]
+
+def print_catalogue_summary(catalogue, selected):
+    '''
+    Print the number of basins of the catalogue and of the selection, per country and subset category
+    Args:
+        catalogue: pandas.DataFrame, basin catalogue
+        selected: pandas.DataFrame, selected rows of the catalogue
+    '''
+    print(f"Basin catalogue: {len(catalogue)} basins, {int(catalogue['on_disk'].sum())} on disk, {len(selected)} selected "
+          f"({selected['cost'].sum() / 2**30:.1f} GB of forcings)")
+    counts = selected.groupby([selected.index.get_level_values('country'), selected['subset_category'].fillna('unknown')]).size()
+    for (country, category), count in counts.items():
+        print(f'  {country} {category}: {count}')
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import concurrent.futures
+
+
+# Threads listing the basin folders (metadata calls mostly wait on the file system)
+SCAN_THREADS = 16
+
+def get_index_path(data_dir_out, data_gen):
+    '''
+    Get the path of the basin index of a run
+    Args:
+        data_dir_out: str, path to the output directory
+        data_gen: dict, data from data_general.yml
+    Returns:
+        index_path: str, path to the JSON index (basin_index_file, or {output dir}/basin_index.json)
+    '''
+    return data_gen.get('basin_index_file') or os.path.join(data_dir_out, 'basin_index.json')
+
+def list_folder_files(folder):
+    '''
+    List the files of a folder with a single os.scandir
+    Args:
+        folder: str, path to the folder
+    Returns:
+        files: set, file names (empty if the folder does not exist)
+    '''
+    if not os.path.isdir(folder):
+        return set()
+    with os.scandir(folder) as entries:
+        return set(entry.name for entry in entries if entry.is_file())
+
+def get_mtime_ns(path):
+    '''
+    Get the modification time of a file or folder
+    Args:
+        path: str, path to the file or folder
+    Returns:
+        mtime_ns: int, modification time in nanoseconds (None if missing)
+    '''
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def scan_basin(basin_data_path, basin_f, relative_path_forc, relative_path_targ, data_sources):
+    '''
+    List the forcing files of each source and the target file of a basin
+    Args:
+        basin_data_path: str, path to the basin_data folder
+        basin_f: str, basin folder name (e.g. 'USA_01013500')
+        relative_path_forc: str, forcing folder relative to the basin folder
+        relative_path_targ: str, target folder relative to the basin folder
+        data_sources: list, forcing data sources
+    Returns:
+        basin_entry: dict, 'sources': sorted [name, size, mtime_ns] of the files of each source,
+                     'target': [name, size, mtime_ns] of the target file (None if missing),
+                     'forcing_mtime_ns': mtime of the forcing folder (None if missing), to check the index is fresh
+    '''
+    folder2load = os.path.join(basin_data_path, basin_f, relative_path_forc)
+    forcing_files = []
+    forcing_mtime_ns = get_mtime_ns(folder2load)
+    if os.path.isdir(folder2load):
+        with os.scandir(folder2load) as entries:
+            for entry in entries:
+                # Skip temporary files
+                if '.tmp' in entry.name or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                forcing_files.append([entry.name, stat.st_size, stat.st_mtime_ns])
+    forcing_files.sort()
+
+    target_name = f'{basin_f}_daily_flow_observations.nc'
+    try:
+        stat = os.stat(os.path.join(basin_data_path, basin_f, relative_path_targ, target_name))
+        target = [target_name, stat.st_size, stat.st_mtime_ns]
+    except OSError:
+        target = None
+
+    return {'sources': {src: [file for file in forcing_files if src in file[0]] for src in data_sources},
+            'target': target, 'forcing_mtime_ns': forcing_mtime_ns}
+
+def is_basin_index_fresh(index, scan_threads=SCAN_THREADS):
+    '''
+    Check that a saved basin index still matches the basin folders, without listing the forcing files:
+    the basin_data folder and the forcing folders change mtime when files are added, removed or replaced
+    by a rename (files rewritten in place are not detected, rescan after that), and the target files are stat'ed
+    Args:
+        index: dict, basin index (see build_basin_index)
+        scan_threads: int, threads checking the basin folders
+    Returns:
+        fresh: bool, whether no basin, forcing folder or target file changed since the index was built
+    '''
+    basin_data_path = index['basin_data_path']
+    if index.get('basin_data_mtime_ns') is None or index['basin_data_mtime_ns'] != get_mtime_ns(basin_data_path):
+        return False
+
+    def is_basin_fresh(item):
+        basin_f, basin_entry = item
+        if 'forcing_mtime_ns' not in basin_entry:
+            return False
+        forcing_folder = os.path.join(basin_data_path, basin_f, index['relative_path_forc'])
+        if get_mtime_ns(forcing_folder) != basin_entry['forcing_mtime_ns']:
+            return False
+        target = basin_entry['target']
+        target_name = f'{basin_f}_daily_flow_observations.nc'
+        try:
+            stat = os.stat(os.path.join(basin_data_path, basin_f, index['relative_path_targ'], target_name))
+        except OSError:
+            return target is None
+        return target == [target_name, stat.st_size, stat.st_mtime_ns]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=scan_threads) as executor:
+        return all(executor.map(is_basin_fresh, index['basins'].items()))
+
+def build_basin_index(basin_data_path, relative_path_forc, relative_path_targ, data_sources, scan_threads=SCAN_THREADS):
+    '''
+    Scan the basin_data folder once: basin -> source -> sorted files with sizes, and the target files
+    Args:
+        basin_data_path: str, path to the basin_data folder
+        relative_path_forc: str, forcing folder relative to the basin folder
+        relative_path_targ: str, target folder relative to the basin folder
+        data_sources: list, forcing data sources
+        scan_threads: int, threads listing the basin folders
+    Returns:
+        index: dict, scan settings and 'basins': basin folder name -> entry (see scan_basin)
+    '''
+    # Before listing, so that basins added during the scan make the index stale
+    basin_data_mtime_ns = get_mtime_ns(basin_data_path)
+    with os.scandir(basin_data_path) as entries:
+        basins = sorted(entry.name for entry in entries if entry.is_dir())
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=scan_threads) as executor:
+        entries = executor.map(lambda basin_f: scan_basin(basin_data_path, basin_f, relative_path_forc,
+                                                          relative_path_targ, data_sources), basins)
+        basin_entries = dict(zip(basins, entries))
+
+    return {'basin_data_path': basin_data_path, 'relative_path_forc': relative_path_forc,
+            'relative_path_targ': relative_path_targ, 'data_sources': data_sources,
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'basin_data_mtime_ns': basin_data_mtime_ns,
+            'basins': basin_entries}
+
+def save_basin_index(index, index_path):
+    '''
+    Save a basin index (through a temporary file, so it is never left half written)
+    Args:
+        index: dict, basin index
+        index_path: str, path to the JSON index
+    '''
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    # One temporary file per process, so that concurrent saves do not remove each other's file
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+def load_basin_index(index_path):
+    '''
+    Load a saved basin index
+    Args:
+        index_path: str, path to the JSON index
+    Returns:
+        index: dict, basin index (None if missing or unreadable)
+    '''
+    try:
+        with open(index_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def get_basin_index(data_dir, data_gen, reuse=False, save=True):
+    '''
+    Get the basin index of a run: reload the saved index, or scan the basins and save it
+    Args:
+        data_dir: dict, data from data_dir.yml
+        data_gen: dict, data from data_general.yml
+        reuse: bool, whether to reload the saved index if it was built with the same folders and sources
+               and the basin folders did not change since (see is_basin_index_fresh)
+        save: bool, whether to save a scanned index (not by the shards of a job array, which share the file)
+    Returns:
+        index: dict, basin index (see build_basin_index)
+    '''
+    basin_data_path = os.path.join(data_dir['data_dir_camels_spat'], 'basin_data')
+    index_path = get_index_path(data_dir['data_dir_camels_spat_nh'], data_gen)
+    settings = {'basin_data_path': basin_data_path, 'relative_path_forc': data_dir['relative_path_forcing'],
+                'relative_path_targ': data_dir['relative_path_target'], 'data_sources': data_gen['data_sources']}
+
+    if reuse:
+        index = load_basin_index(index_path)
+        if index is not None and all(index.get(key) == value for key, value in settings.items()):
+            if is_basin_index_fresh(index):
+                print(f"Basin index: {len(index['basins'])} basins loaded from {index_path} (scanned {index['created']})")
+                return index
+            print(f"Basin folders changed since the index in {index_path} was scanned, scanning the basins...")
+        else:
+            print(f"No matching basin index in {index_path}, scanning the basins...")
+
+    start_time = time.time()
+    index = build_basin_index(**settings)
+    if save:
+        save_basin_index(index, index_path)
+        print(f"Basin index: {len(index['basins'])} basins scanned in {time.time() - start_time:.2f} s -> {index_path}")
+    else:
+        print(f"Basin index: {len(index['basins'])} basins scanned in {time.time() - start_time:.2f} s")
+    return index
+
+def get_basin_cost(basin_entry):
+    '''
+    Estimate the processing cost of a basin as the total size of its forcing files
+    Args:
+        basin_entry: dict, basin entry of the index
+    Returns:
+        cost: int, total size in bytes of the forcing files
+    '''
+    return sum(file[1] for files in basin_entry['sources'].values() for file in files)
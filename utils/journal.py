@@ -0,0 +1,91 @@
+import os
+import json
+import time
+import glob
+import socket
+
+
+# Journal folder, inside the output directory
+JOURNAL_DIR = 'journal'
+# Basins in these states are not converted again by --resume
+FINISHED_STATES = ('done', 'skipped', 'up_to_date')
+
+def get_journal_path(data_dir_out, shard_index=0, shard_count=1):
+    '''
+    Get the journal file of a shard (one file per shard, so that the tasks of a job array do not share a file)
+    Args:
+        data_dir_out: str, path to the output directory
+        shard_index: int, index of the shard (0-based)
+        shard_count: int, number of shards
+    Returns:
+        journal_path: str, path to {output dir}/journal/shard_{index}_of_{count}.jsonl
+    '''
+    return os.path.join(data_dir_out, JOURNAL_DIR, f'shard_{shard_index}_of_{shard_count}.jsonl')
+
+def journal_basins(journal_path, basins, state, **fields):
+    '''
+    Append the state of basins to a journal, one JSON line per basin
+    The lines are appended with a single write to a file opened in append mode, so that the worker
+    processes can share the journal and a killed run leaves at most a truncated last line, which is ended
+    before the new lines are appended
+    Args:
+        journal_path: str, path to the journal (nothing is recorded if None)
+        basins: list, basin folder names
+        state: str, 'pending', 'running', 'done', 'skipped', 'up_to_date' or 'failed'
+        fields: extra fields of the records (e.g. seconds, error)
+    '''
+    if journal_path is None or len(basins) == 0:
+        return
+    record = {'state': state, 'time': time.time(), 'host': socket.gethostname(), 'pid': os.getpid(), **fields}
+    lines = ''.join(json.dumps({'basin': basin_f, **record}) + '\n' for basin_f in basins)
+
+    os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+    fd = os.open(journal_path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        # Line cut by a killed run: end it, so that the new records are not glued to it
+        size = os.fstat(fd).st_size
+        if size > 0 and os.pread(fd, 1, size - 1) != b'\n':
+            lines = '\n' + lines
+        os.write(fd, lines.encode())
+    finally:
+        os.close(fd)
+
+def read_journal(data_dir_out):
+    '''
+    Read the journals of all the shards of an output directory
+    Args:
+        data_dir_out: str, path to the output directory
+    Returns:
+        states: dict, basin folder name -> latest record of the basin ('state', 'time', 'error', ...)
+    '''
+    states = {}
+    for journal_path in sorted(glob.glob(os.path.join(data_dir_out, JOURNAL_DIR, '*.jsonl'))):
+        with open(journal_path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Line cut by a killed run
+                    continue
+                if record['basin'] not in states or record['time'] >= states[record['basin']]['time']:
+                    states[record['basin']] = record
+    return states
+
+def print_journal_summary(states, basins):
+    '''
+    Print the number of basins in each state and the failed basins
+    Args:
+        states: dict, latest record of each basin (see read_journal)
+        basins: list, basin folder names to summarize
+    '''
+    counts = {}
+    for basin_f in basins:
+        state = states[basin_f]['state'] if basin_f in states else 'not started'
+        counts[state] = counts.get(state, 0) + 1
+    print('Basin states:', ', '.join(f'{state} {count}' for state, count in sorted(counts.items())))
+
+    failed = [basin_f for basin_f in basins if basin_f in states and states[basin_f]['state'] == 'failed']
+    for basin_f in failed[:20]:
+        print(f"  {basin_f} failed: {states[basin_f].get('error')}")
+    if len(failed) > 0:
+        print(f"{len(failed)} basins failed, convert them again with --resume")
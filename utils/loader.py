@@ -0,0 +1,243 @@
+import os
+import json
+import threading
+import collections
+import concurrent.futures
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.utils import load_util_data
+from utils.writers import get_basin_output_path, read_basin
+from utils.stats import get_output_format
+
+
+# Get the root directory of the project with Path
+ROOT_DIR = Path(__file__).resolve().parents[1]
+# Sidecar folder of the memory-mapped copies of the basins, inside each country output folder
+MAPS_DIR = '.mmap'
+# Basins kept open by load_basin (two maps each: values and dates), least recently used closed first
+MAX_OPEN_MAPS = 128
+# Processes building the maps of a country folder
+MAP_WORKERS = 8
+
+# Open maps of the process: values path -> (values, dates, column index, size and mtime of the output file)
+OPEN_MAPS = collections.OrderedDict()
+OPEN_MAPS_LOCK = threading.Lock()
+# Output settings read from the yml files by load_basin when not given
+OUTPUT_SETTINGS = {}
+
+def get_map_paths(file_path):
+    '''
+    Get the paths of the memory-mapped copy of a basin output file
+    Args:
+        file_path: str, path to the basin output file
+    Returns:
+        values_path: str, {country_dir}/.mmap/{basin_id}.npy, values (days x columns, one contiguous block per column)
+        dates_path: str, {country_dir}/.mmap/{basin_id}.dates.npy, datetime64[ns] dates of the rows
+        meta_path: str, {country_dir}/.mmap/{basin_id}.json, columns, tagged with the size and mtime of the output file
+    '''
+    folder, file_name = os.path.split(file_path)
+    basin_id = os.path.splitext(file_name)[0]
+    maps_dir = os.path.join(folder, MAPS_DIR)
+    return (os.path.join(maps_dir, basin_id + '.npy'), os.path.join(maps_dir, basin_id + '.dates.npy'),
+            os.path.join(maps_dir, basin_id + '.json'))
+
+def save_npy(file_path, array):
+    '''
+    Save an array to a .npy file (through a temporary file)
+    Args:
+        file_path: str, path to the .npy file
+        array: numpy.ndarray, array to save
+    '''
+    with open(file_path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(file_path + '.tmp', file_path)
+
+def build_basin_map(file_path):
+    '''
+    Write the memory-mapped copy of a basin output file (values in column-major order, so that reading
+    a column only touches its own pages, and the dates in a sidecar)
+    Args:
+        file_path: str, path to the basin output file
+    Returns:
+        meta: dict, 'columns', 'rows', 'dtype' and the 'size' and 'mtime_ns' of the output file
+    '''
+    stat = os.stat(file_path)
+    df = read_basin(file_path, get_output_format(file_path))
+    columns = [col for col in df.columns if col != 'date' and np.issubdtype(df[col].dtype, np.number)]
+    # float32 for the typed outputs (parquet, feather, netcdf), float64 for csv
+    dtype = np.result_type(*[df[col].dtype for col in columns], np.float32) if columns else np.float32
+
+    values_path, dates_path, meta_path = get_map_paths(file_path)
+    os.makedirs(os.path.dirname(values_path), exist_ok=True)
+    save_npy(values_path, np.asfortranarray(df[columns].to_numpy(dtype=dtype)))
+    save_npy(dates_path, pd.to_datetime(df['date']).to_numpy(dtype='datetime64[ns]'))
+    # Written last: a map is only used once its meta file is there
+    meta = {'columns': columns, 'rows': len(df), 'dtype': np.dtype(dtype).name,
+            'file': os.path.basename(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    return meta
+
+def read_map_meta(file_path):
+    '''
+    Read the meta file of the memory-mapped copy of a basin output file
+    Args:
+        file_path: str, path to the basin output file
+    Returns:
+        meta: dict, meta of the map (None if missing, or stale when the output file exists)
+    '''
+    try:
+        with open(get_map_paths(file_path)[2], 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        # Output file removed (e.g. to save space): the map is used as is
+        return meta
+    if meta.get('size') != stat.st_size or meta.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+    return meta
+
+def open_basin_map(file_path):
+    '''
+    Open the memory-mapped copy of a basin output file, building it first if missing or stale
+    The maps stay open in an LRU cache of MAX_OPEN_MAPS basins, for repeated access across many basins
+    Args:
+        file_path: str, path to the basin output file
+    Returns:
+        values: numpy.memmap, read-only values (days x columns)
+        dates: numpy.memmap, read-only datetime64[ns] dates of the rows
+        column_index: dict, column -> index in values
+    '''
+    values_path = get_map_paths(file_path)[0]
+    # Checked at every access, as the summaries, so that a rewritten output is mapped again
+    try:
+        stat = os.stat(file_path)
+        state = (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        state = None
+
+    with OPEN_MAPS_LOCK:
+        if values_path in OPEN_MAPS and OPEN_MAPS[values_path][3] == state:
+            OPEN_MAPS.move_to_end(values_path)
+            return OPEN_MAPS[values_path][:3]
+
+    meta = read_map_meta(file_path)
+    if meta is None:
+        if state is None:
+            raise FileNotFoundError(f"No output file or map for {file_path}")
+        meta = build_basin_map(file_path)
+    values_path, dates_path, _ = get_map_paths(file_path)
+    values = np.load(values_path, mmap_mode='r')
+    dates = np.load(dates_path, mmap_mode='r')
+    column_index = {col: i for i, col in enumerate(meta['columns'])}
+
+    with OPEN_MAPS_LOCK:
+        # Evicted maps are closed once no frame uses their columns
+        OPEN_MAPS[values_path] = (values, dates, column_index, state)
+        OPEN_MAPS.move_to_end(values_path)
+        while len(OPEN_MAPS) > MAX_OPEN_MAPS:
+            OPEN_MAPS.popitem(last=False)
+    return values, dates, column_index
+
+def clear_open_maps():
+    '''
+    Drop the maps kept open by load_basin
+    '''
+    with OPEN_MAPS_LOCK:
+        OPEN_MAPS.clear()
+
+def get_output_settings():
+    '''
+    Get the output directory, number of sources and output format of data_dir.yml and data_general.yml (read once)
+    Returns:
+        settings: dict, 'data_dir_out', 'n_sources' and 'output_format'
+    '''
+    if not OUTPUT_SETTINGS:
+        data_dir, data_gen = load_util_data(str(ROOT_DIR))
+        OUTPUT_SETTINGS.update({'data_dir_out': data_dir['data_dir_camels_spat_nh'],
+                                'n_sources': len(data_gen['data_sources']),
+                                'output_format': data_gen.get('output_format', 'csv')})
+    return OUTPUT_SETTINGS
+
+def load_basin(country, basin_id, columns=None, start=None, end=None,
+               data_dir_out=None, n_sources=None, output_format=None, copy=False):
+    '''
+    Load a window of a converted basin from its memory-mapped copy (built from the output file on first use)
+    Only the pages of the requested columns and days are read: the columns of the frame are read-only views
+    of the maps, unless copy is True
+    Args:
+        country: str, country code (e.g. 'USA')
+        basin_id: str, basin id (e.g. '01013500')
+        columns: list, columns to load (all if None); 'date' is always included
+        start: str or datetime, first day (from the first day of the basin if None)
+        end: str or datetime, last day, included (to the last day of the basin if None)
+        data_dir_out: str, path to the output directory (data_dir.yml if None)
+        n_sources: int, number of forcing data sources of the outputs (data_general.yml if None)
+        output_format: str, format of the output files (data_general.yml if None)
+        copy: bool, whether to copy the window into a writable frame
+    Returns:
+        df: pandas.DataFrame, 'date' column and the requested columns, for the days in [start, end]
+    '''
+    settings = get_output_settings() if None in (data_dir_out, n_sources, output_format) else {}
+    data_dir_out = data_dir_out or settings['data_dir_out']
+    n_sources = n_sources or settings['n_sources']
+    output_format = output_format or settings['output_format']
+    # Same folders as get_country_dir in camels_spat2nh.py
+    country_dir = os.path.join(data_dir_out, f'CAMELS_spat_{country}_{n_sources}sources')
+    file_path = get_basin_output_path(country_dir, basin_id, output_format)
+
+    try:
+        values, dates, column_index = open_basin_map(file_path)
+    except OSError:
+        # Read-only output folder without map: windowed read of the output file
+        df = read_basin(file_path, output_format, columns)
+        mask = pd.Series(True, index=df.index)
+        if start is not None:
+            mask &= df['date'] >= pd.Timestamp(start)
+        if end is not None:
+            mask &= df['date'] <= pd.Timestamp(end)
+        return df[mask].reset_index(drop=True)
+
+    if columns is None:
+        columns = list(column_index)
+    columns = [col for col in columns if col != 'date']
+    missing = [col for col in columns if col not in column_index]
+    if missing:
+        raise KeyError(f"Columns {missing} not in {country}_{basin_id}, expected some of {list(column_index)}")
+
+    # Rows of the window (the dates are sorted)
+    first = 0 if start is None else int(np.searchsorted(dates, np.datetime64(pd.Timestamp(start), 'ns'), side='left'))
+    last = len(dates) if end is None else int(np.searchsorted(dates, np.datetime64(pd.Timestamp(end), 'ns'), side='right'))
+
+    data = {'date': dates[first:last]}
+    data.update((col, values[first:last, column_index[col]]) for col in columns)
+    return pd.DataFrame(data, copy=copy)
+
+def build_country_maps(country_dir, max_workers=MAP_WORKERS):
+    '''
+    Build the missing or stale maps of all the basin output files of a country folder (ahead of training,
+    so that load_basin never reads an output file)
+    Args:
+        country_dir: str, path to the country output folder
+        max_workers: int, processes building the maps
+    Returns:
+        n_built: int, number of maps built
+    '''
+    with os.scandir(country_dir) as entries:
+        file_paths = sorted(os.path.join(country_dir, entry.name) for entry in entries
+                            if entry.is_file() and get_output_format(entry.name) is not None)
+    missing = [file_path for file_path in file_paths if read_map_meta(file_path) is None]
+    if len(missing) > 1 and max_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+            list(executor.map(build_basin_map, missing, chunksize=16))
+    else:
+        for file_path in missing:
+            build_basin_map(file_path)
+    return len(missing)
@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import glob
+import socket
+import cProfile
+import resource
+from contextlib import contextmanager
+
+
+# Detailed progress messages are only printed in verbose mode
+VERBOSE = False
+
+def set_verbose(verbose):
+    '''
+    Switch verbose logging on or off in the current process
+    Args:
+        verbose: bool, whether to print detailed progress messages
+    '''
+    global VERBOSE
+    VERBOSE = bool(verbose)
+
+def vprint(*args, **kwargs):
+    '''
+    Print only in verbose mode (arguments as for print)
+    '''
+    if VERBOSE:
+        print(*args, **kwargs)
+
+def get_process_peak_rss_mb():
+    '''
+    Get the peak resident memory of the current process since it started (not of a single basin,
+    as the worker processes convert many basins)
+    Returns:
+        peak_rss: float, peak RSS in MB
+    '''
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak_rss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+def new_basin_record(basin_f):
+    '''
+    Start the profiling record of a basin
+    Args:
+        basin_f: str, basin folder name (e.g. 'USA_01013500')
+    Returns:
+        record: dict, record with stage timers and per-source counters
+    '''
+    return {'basin': basin_f, 'host': socket.gethostname(), 'pid': os.getpid(), 'status': 'running',
+            'start': time.time(), 'wall': 0.0, 'stages': {}, 'sources': {}}
+
+def get_source_record(record, src):
+    '''
+    Get (or create) the counters of a data source in a basin record
+    Args:
+        record: dict, basin record (None when profiling is off)
+        src: str, data source name
+    Returns:
+        source_record: dict, files opened, bytes read and stage timers of the source
+    '''
+    if record is None:
+        return None
+    return record['sources'].setdefault(src, {'files': 0, 'bytes': 0, 'cached': False, 'stages': {}})
+
+def add_time(record, stage, seconds):
+    '''
+    Add wall time to a stage of a record
+    Args:
+        record: dict, basin or source record (None when profiling is off)
+        stage: str, stage name (e.g. 'open', 'reduce', 'merge', 'write')
+        seconds: float, wall time to add
+    '''
+    if record is not None:
+        record['stages'][stage] = record['stages'].get(stage, 0.0) + seconds
+
+@contextmanager
+def stage_timer(record, stage):
+    '''
+    Time a block of code and add it to a stage of a record
+    Args:
+        record: dict, basin or source record (None when profiling is off)
+        stage: str, stage name
+    '''
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(record, stage, time.perf_counter() - start_time)
+
+def finish_basin_record(record, status, profile_dir, error=None):
+    '''
+    Close a basin record and append it as a JSON line to the file of the current process
+    Args:
+        record: dict, basin record (None when profiling is off)
+        status: str, 'done', 'skipped', 'up_to_date' or 'error'
+        profile_dir: str, folder of the JSON lines files
+        error: str, error message if the basin failed
+    '''
+    if record is None:
+        return
+    record['status'] = status
+    record['wall'] = time.time() - record['start']
+    # Peak of the process so far: the largest basin converted by the process until this one
+    record['process_peak_rss_mb'] = round(get_process_peak_rss_mb(), 1)
+    if error is not None:
+        record['error'] = error
+    # Stage totals of the basin: sum of its sources plus its own stages
+    for source_record in record['sources'].values():
+        for stage, seconds in source_record['stages'].items():
+            record['stages'][stage] = record['stages'].get(stage, 0.0) + seconds
+
+    os.makedirs(profile_dir, exist_ok=True)
+    stats_file = os.path.join(profile_dir, f'stats_{socket.gethostname()}_{os.getpid()}.jsonl')
+    with open(stats_file, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+@contextmanager
+def cprofile_basin(basin_f, profile_dir, enabled=True):
+    '''
+    Run a block under cProfile and dump the stats to {profile_dir}/{basin_f}.prof
+    Args:
+        basin_f: str, basin folder name
+        profile_dir: str, folder of the profiling outputs
+        enabled: bool, whether to profile
+    '''
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(profile_dir, exist_ok=True)
+        profiler.dump_stats(os.path.join(profile_dir, f'{basin_f}.prof'))
+
+def load_profile_records(profile_dir):
+    '''
+    Load the basin records written by all processes (and nodes) of a run
+    Args:
+        profile_dir: str, folder of the JSON lines files
+    Returns:
+        records: list, basin records
+    '''
+    records = []
+    for stats_file in sorted(glob.glob(os.path.join(profile_dir, 'stats_*.jsonl'))):
+        with open(stats_file, 'r') as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return records
+
+def summarize_profile(profile_dir, n_slowest=10):
+    '''
+    Print a summary of a run: basins per status, total time per stage and slowest basins
+    Args:
+        profile_dir: str, folder of the JSON lines files
+        n_slowest: int, number of slowest basins to list
+    Returns:
+        records: list, basin records of the run
+    '''
+    records = load_profile_records(profile_dir)
+    if len(records) == 0:
+        print('No profiling records in', profile_dir)
+        return records
+
+    statuses, stages = {}, {}
+    for record in records:
+        statuses[record['status']] = statuses.get(record['status'], 0) + 1
+        for stage, seconds in record['stages'].items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    print(f"\n--- Profiling summary ({profile_dir}) ---")
+    print('Basins:', statuses)
+    print('Peak RSS of the largest process (MB, over all its basins):',
+          max(record.get('process_peak_rss_mb', 0) for record in records))
+    print('Time per stage (s, summed over basins):')
+    for stage, seconds in sorted(stages.items(), key=lambda item: -item[1]):
+        print(f"  {stage:<10}{seconds:>10.2f}")
+    print(f'Slowest basins:')
+    for record in sorted(records, key=lambda record: -record['wall'])[:n_slowest]:
+        slowest_stage = max(record['stages'].items(), key=lambda item: item[1], default=('-', 0.0))
+        print(f"  {record['basin']:<16}{record['wall']:>8.2f} s  ({record['status']}, "
+              f"slowest stage {slowest_stage[0]} {slowest_stage[1]:.2f} s)")
+    return records
@@ -0,0 +1,138 @@
+import os
+import json
+import concurrent.futures
+
+import numpy as np
+import pandas as pd
+
+from utils.writers import OUTPUT_EXTENSIONS, read_basin
+
+
+# Sidecar folder of the basin summaries, inside each country output folder
+SUMMARY_DIR = '.summary'
+# Processes reading the date column of the outputs without summary
+SUMMARY_WORKERS = 8
+
+def get_summary_path(file_path):
+    '''
+    Get the path of the summary sidecar of a basin output file
+    Args:
+        file_path: str, path to the basin output file
+    Returns:
+        summary_path: str, path to {country_dir}/.summary/{file name}.json
+    '''
+    folder, file_name = os.path.split(file_path)
+    return os.path.join(folder, SUMMARY_DIR, file_name + '.json')
+
+def summarize_basin_frame(df):
+    '''
+    Summarize a basin DataFrame: date range, row count, and NaN count and value range of each column
+    Args:
+        df: pandas.DataFrame, basin data with a 'date' column
+    Returns:
+        summary: dict, 'rows', 'start', 'end' (YYYY-MM-DD) and 'columns': {column: {'nan', 'min', 'max'}}
+    '''
+    dates = pd.to_datetime(df['date'])
+    cols = [col for col in df.columns if col != 'date' and np.issubdtype(df[col].dtype, np.number)]
+    values = df[cols].to_numpy(dtype=float)
+    # fmin/fmax skip NaN values (NaN only for all-NaN columns)
+    nans = np.isnan(values).sum(axis=0)
+    mins = np.fmin.reduce(values, axis=0) if len(values) else np.full(len(cols), np.nan)
+    maxs = np.fmax.reduce(values, axis=0) if len(values) else np.full(len(cols), np.nan)
+
+    return {'rows': len(df),
+            'start': dates.min().strftime('%Y-%m-%d') if len(df) else None,
+            'end': dates.max().strftime('%Y-%m-%d') if len(df) else None,
+            'columns': {col: {'nan': int(nans[i]),
+                              'min': None if np.isnan(mins[i]) else float(mins[i]),
+                              'max': None if np.isnan(maxs[i]) else float(maxs[i])} for i, col in enumerate(cols)}}
+
+def write_basin_summary(file_path, summary):
+    '''
+    Write the summary sidecar of a basin output file, tagged with the size and mtime of the file
+    Args:
+        file_path: str, path to the basin output file (already written)
+        summary: dict, summary of the basin (see summarize_basin_frame)
+    '''
+    stat = os.stat(file_path)
+    summary = {**summary, 'file': os.path.basename(file_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    summary_path = get_summary_path(file_path)
+    os.makedirs(os.path.dirname(summary_path), exist_ok=True)
+    with open(summary_path + '.tmp', 'w') as f:
+        json.dump(summary, f)
+    os.replace(summary_path + '.tmp', summary_path)
+
+def read_basin_summary(file_path):
+    '''
+    Read the summary sidecar of a basin output file if it is up to date with the file
+    Args:
+        file_path: str, path to the basin output file
+    Returns:
+        summary: dict, summary of the basin (None if missing or stale)
+    '''
+    try:
+        with open(get_summary_path(file_path), 'r') as f:
+            summary = json.load(f)
+        stat = os.stat(file_path)
+    except (OSError, ValueError):
+        return None
+    if summary.get('size') != stat.st_size or summary.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+    return summary
+
+def get_output_format(file_name):
+    '''
+    Get the output format of a basin output file from its extension
+    Args:
+        file_name: str, name of the file
+    Returns:
+        output_format: str, one of OUTPUT_EXTENSIONS (None for other files)
+    '''
+    for output_format, extension in OUTPUT_EXTENSIONS.items():
+        if file_name.endswith(extension):
+            return output_format
+    return None
+
+def summarize_output_file(file_path):
+    '''
+    Get the summary of a basin output file: from its sidecar if up to date, otherwise from its date column only
+    (the summary is then cached in the sidecar, without column statistics)
+    Args:
+        file_path: str, path to the basin output file
+    Returns:
+        summary: dict, summary of the basin (see summarize_basin_frame)
+    '''
+    summary = read_basin_summary(file_path)
+    if summary is None:
+        df = read_basin(file_path, get_output_format(file_path), columns=['date'])
+        summary = summarize_basin_frame(df)
+        try:
+            write_basin_summary(file_path, summary)
+        except OSError:
+            # Read-only outputs: the summary is recomputed next time
+            pass
+    return summary
+
+def get_country_summaries(country_dir, max_workers=SUMMARY_WORKERS):
+    '''
+    Get the summaries of all the basin output files of a country folder
+    Outputs without an up-to-date sidecar are read (date column only) by a process pool
+    Args:
+        country_dir: str, path to the country output folder
+        max_workers: int, processes reading the outputs without summary
+    Returns:
+        summaries: dict, basin id -> summary, sorted by basin id
+    '''
+    with os.scandir(country_dir) as entries:
+        file_names = sorted(entry.name for entry in entries if entry.is_file() and get_output_format(entry.name) is not None)
+    file_paths = [os.path.join(country_dir, file_name) for file_name in file_names]
+
+    summaries = {file_path: read_basin_summary(file_path) for file_path in file_paths}
+    missing = [file_path for file_path, summary in summaries.items() if summary is None]
+    if len(missing) > 1 and max_workers > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+            summaries.update(zip(missing, executor.map(summarize_output_file, missing, chunksize=16)))
+    else:
+        summaries.update((file_path, summarize_output_file(file_path)) for file_path in missing)
+
+    return {os.path.basename(file_path).split('_')[-1].split('.')[0]: summary for file_path, summary in summaries.items()}
@@ -0,0 +1,176 @@
+import os
+import numpy as np
+import xarray as xr
+import pandas as pd
+import h5netcdf.legacyapi as h5nc
+
+from utils.utils import NETCDF_LOCK
+
+
+# File extension of each consolidated store format
+STORE_EXTENSIONS = {
+    'netcdf': '.nc',
+    'zarr': '.zarr',
+}
+# Number of days per chunk of the (basin, date) variables
+STORE_DATE_CHUNK = 3653
+
+def get_store_path(data_dir_out, group, n_sources, store_format='netcdf'):
+    '''
+    Get the path of a consolidated store, named like the per-basin output folders
+    Args:
+        data_dir_out: str, path to the output directory
+        group: str, country code (e.g. 'USA') or 'all'
+        n_sources: int, number of forcing data sources
+        store_format: str, one of STORE_EXTENSIONS
+    Returns:
+        store_path: str, path to the store (e.g. CAMELS_spat_USA_4sources.nc)
+    '''
+    if store_format not in STORE_EXTENSIONS:
+        raise ValueError(f"Unknown store format '{store_format}', expected one of {list(STORE_EXTENSIONS)}")
+    return os.path.join(data_dir_out, f'CAMELS_spat_{group}_{n_sources}sources{STORE_EXTENSIONS[store_format]}')
+
+def get_store_dates(store_dates):
+    '''
+    Build the daily date axis shared by all basins of a store
+    Args:
+        store_dates: list, first and last date of the store (e.g. ['1950-01-01', '2023-12-31'])
+    Returns:
+        dates: pandas.DatetimeIndex, daily dates
+    '''
+    return pd.date_range(pd.Timestamp(str(store_dates[0])), pd.Timestamp(str(store_dates[-1])), freq='D')
+
+def read_store_basins(store_path, store_format='netcdf'):
+    '''
+    List the basins already written to a store
+    Args:
+        store_path: str, path to the store
+        store_format: str, one of STORE_EXTENSIONS
+    Returns:
+        basins: list, basin ids in store order
+    '''
+    if not os.path.exists(store_path):
+        return []
+    if store_format == 'zarr':
+        with xr.open_zarr(store_path) as ds:
+            return [str(basin) for basin in ds['basin'].values]
+    with NETCDF_LOCK, h5nc.Dataset(store_path, 'r') as f:
+        return [str(basin) for basin in f.variables['basin'][:]]
+
+def _basin_values(df, dates):
+    '''
+    Align a basin DataFrame on the store dates
+    Args:
+        df: pandas.DataFrame, basin data with a 'date' column
+        dates: pandas.DatetimeIndex, daily dates of the store
+    Returns:
+        values: pandas.DataFrame, float32 values indexed by the store dates
+        n_dropped: int, number of basin rows outside the store dates
+    '''
+    df = df.set_index(pd.to_datetime(df['date'])).drop(columns='date')
+    n_dropped = int((~df.index.isin(dates)).sum())
+    return df.reindex(dates).astype(np.float32), n_dropped
+
+def _append_netcdf(store_path, basin_id, country, values, dates):
+    '''
+    Append one basin to a netCDF store with an unlimited 'basin' dimension
+    Args:
+        store_path: str, path to the store
+        basin_id: str, basin id
+        country: str, country code of the basin
+        values: pandas.DataFrame, float32 values indexed by the store dates
+        dates: pandas.DatetimeIndex, daily dates of the store
+    '''
+    new_store = not os.path.exists(store_path)
+    with h5nc.Dataset(store_path, 'w' if new_store else 'a') as f:
+        if new_store:
+            f.createDimension('basin', None)
+            f.createDimension('date', len(dates))
+            date = f.createVariable('date', 'i4', ('date',))
+            date.units = 'days since 1970-01-01'
+            date.calendar = 'standard'
+            date[:] = (dates - pd.Timestamp('1970-01-01')).days.values
+            f.createVariable('basin', str, ('basin',))
+            f.createVariable('country', str, ('basin',))
+        elif f.dimensions['date'].size != len(dates):
+            raise ValueError(f"{store_path} has {f.dimensions['date'].size} dates, expected {len(dates)}")
+
+        # Rebuilt basins overwrite their row, new basins are appended
+        basins = [str(basin) for basin in f.variables['basin'][:]] if not new_store else []
+        if basin_id in basins:
+            i = basins.index(basin_id)
+            for var in f.variables:
+                if f.variables[var].dimensions == ('basin', 'date') and var not in values.columns:
+                    f.variables[var][i, :] = np.nan
+        else:
+            i = len(basins)
+            f.resize_dimension('basin', i + 1)
+            f.variables['basin'][i] = basin_id
+        f.variables['country'][i] = country
+
+        for col in values.columns:
+            if col not in f.variables:
+                # Columns first seen in this basin are missing (NaN) for the previous ones
+                f.createVariable(col, 'f4', ('basin', 'date'), fill_value=np.nan,
+                                 chunksizes=(1, min(len(dates), STORE_DATE_CHUNK)))
+            f.variables[col][i, :] = values[col].values
+
+def _append_zarr(store_path, basin_id, country, values, dates):
+    '''
+    Append one basin to a zarr store along the 'basin' dimension (requires zarr)
+    Args:
+        store_path: str, path to the store
+        basin_id: str, basin id
+        country: str, country code of the basin
+        values: pandas.DataFrame, float32 values indexed by the store dates
+        dates: pandas.DatetimeIndex, daily dates of the store
+    '''
+    basins = []
+    if os.path.exists(store_path):
+        # A zarr append cannot add variables: keep the layout of the store
+        with xr.open_zarr(store_path) as ds:
+            store_vars = [var for var in ds.data_vars if var != 'country']
+            basins = [str(basin) for basin in ds['basin'].values]
+        new_cols = [col for col in values.columns if col not in store_vars]
+        if new_cols:
+            print(f"Warning: {basin_id} columns {new_cols} are not in {store_path} and are not stored")
+        values = values.reindex(columns=store_vars)
+
+    ds = xr.Dataset({col: (('basin', 'date'), values[col].values[np.newaxis]) for col in values.columns},
+                    coords={'basin': np.array([basin_id], dtype=object), 'date': dates})
+    ds['country'] = ('basin', np.array([country], dtype=object))
+
+    if basin_id in basins:
+        # Rebuilt basins overwrite their row
+        i = basins.index(basin_id)
+        ds.drop_vars('date').to_zarr(store_path, region={'basin': slice(i, i + 1)})
+    elif os.path.exists(store_path):
+        ds.to_zarr(store_path, append_dim='basin')
+    else:
+        chunks = (1, min(len(dates), STORE_DATE_CHUNK))
+        ds.to_zarr(store_path, mode='w', encoding={col: {'chunks': chunks} for col in values.columns})
+
+def append_basin_to_store(store_path, basin_id, df, dates, store_format='netcdf', country=''):
+    '''
+    Append a converted basin to a consolidated (basin, date) store, one variable per column
+    A basin already in the store is overwritten
+    Args:
+        store_path: str, path to the store
+        basin_id: str, basin id
+        df: pandas.DataFrame, basin data with a 'date' column
+        dates: pandas.DatetimeIndex, daily dates of the store
+        store_format: str, one of STORE_EXTENSIONS
+        country: str, country code of the basin
+    '''
+    values, n_dropped = _basin_values(df, dates)
+    if n_dropped > 0:
+        print(f"Warning: {n_dropped} days of {basin_id} are outside the store dates and are not stored")
+
+    if store_format == 'netcdf':
+        # h5py shares libhdf5 with the netCDF outputs written by the write-behind threads
+        with NETCDF_LOCK:
+            _append_netcdf(store_path, basin_id, country, values, dates)
+    elif store_format == 'zarr':
+        _append_zarr(store_path, basin_id, country, values, dates)
+    else:
+        raise ValueError(f"Unknown store format '{store_format}', expected one of {list(STORE_EXTENSIONS)}")
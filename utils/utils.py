@@ -1,77 +1,504 @@
 import os
 import yaml
+import numpy as np
 import xarray as xr
 import pandas as pd
 import matplotlib.pyplot as plt
 import math
+import threading
+import collections
+import concurrent.futures
+from functools import reduce
 
+from utils.profiling import stage_timer, vprint
+from utils.stats import get_country_summaries
 
-def reduceDataByDay(dataset, set_vars, sum_vars, input_vars_repeated, forcing_src):
+# The netCDF4/HDF5 libraries are not thread safe: reader threads open and read one file at a time
+# (they overlap the reading with the reduction and the other sources, not with each other)
+NETCDF_LOCK = threading.RLock()
+
+def reduceDataByDay(dataset, set_vars, sum_vars, input_vars_repeated, forcing_src, dtype='float64', steps_per_day=None):
     '''
     Reduce the input dataset to daily frequency
+    All variables are stacked into one array and reduced together by daily_stats_kernel
     Args:
         dataset: xarray.Dataset, input dataset
         set_vars: list, variables to be averaged
         sum_vars: list, variables to be summed
         input_vars_repeated: list, variables that appear repeatedly
+        dtype: str, dtype of the daily values ('float64' or 'float32', always accumulated in float64)
+        steps_per_day: int, time steps per day of the source (see get_source_steps_per_day), detected if None
     Returns:
         daily_data: xarray.Dataset, dataset with daily frequency
     '''
+    return reduce_files_by_day([dataset], set_vars, sum_vars, input_vars_repeated, forcing_src, dtype, steps_per_day)
 
-    # Convert data to daily frequency
-    day_dates = pd.to_datetime(dataset.coords["time"].values).normalize()
-    day_dates = xr.DataArray(day_dates, name="time", dims="time")
+def load_forcing_file(file_path):
+    '''
+    Load a forcing file into memory and close it
+    Args:
+        file_path: str, path to the forcing file
+    Returns:
+        basin_data: xarray.Dataset, in-memory dataset
+    '''
+    with NETCDF_LOCK, xr.open_dataset(file_path) as basin_data:
+        return basin_data.load()
+
+def iter_forcing_files(folder2load, files2load, source_record=None, prefetch=0):
+    '''
+    Load forcing files one at a time, closing each file handle once it is in memory
+    With prefetch > 0, the next files are loaded by background threads while the current one is used
+    Args:
+        folder2load: str, path to the forcing folder of the basin
+        files2load: list, sorted forcing file names of one data source
+        source_record: dict, profiling counters of the source (files, bytes, 'open' time), optional
+        prefetch: int, number of files loaded ahead (0 to load each file when it is needed)
+    Returns:
+        basin_data: xarray.Dataset, generator of in-memory datasets, one per file
+    '''
+    file_paths = [os.path.join(folder2load, file2load) for file2load in files2load]
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch) if prefetch > 0 else None
+    # Files being loaded, from the current one on
+    pending = collections.deque()
+    try:
+        for i, file_path in enumerate(file_paths):
+            while executor is not None and len(pending) <= prefetch and i + len(pending) < len(file_paths):
+                pending.append(executor.submit(load_forcing_file, file_paths[i + len(pending)]))
+            # Time spent waiting for the file (reading overlapped with the reduction is not counted)
+            with stage_timer(source_record, 'open'):
+                basin_data = pending.popleft().result() if executor is not None else load_forcing_file(file_path)
+            if source_record is not None:
+                source_record['files'] += 1
+                source_record['bytes'] += os.path.getsize(file_path)
+            yield basin_data
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+# Time steps per day of the sources detected from their files, per process (see get_source_steps_per_day)
+SOURCE_STEPS = {}
+DAY_NS = 86400 * 10**9
+
+def get_source_steps_per_day(src, file_path, data_gen):
+    '''
+    Get the number of time steps per day of a data source: 24 for hourly sources, 1 for daily sources (daymet)
+    Declared in source_steps_per_day in data_general.yml, otherwise detected once from the most common
+    time step of a file of the source and reused for all the basins
+    Args:
+        src: str, data source name
+        file_path: str, path to a forcing file of the source (only read if the source is not declared)
+        data_gen: dict, data from data_general.yml
+    Returns:
+        steps_per_day: int, time steps per day of the source
+    '''
+    declared = (data_gen.get('source_steps_per_day') or {}).get(src)
+    if declared:
+        return int(declared)
 
-    print('day_dates', day_dates)
+    if src not in SOURCE_STEPS:
+        with NETCDF_LOCK, xr.open_dataset(file_path) as dataset:
+            time_diff = pd.to_datetime(dataset.coords['time'].values).to_series().diff().dropna()
+        time_step = time_diff.mode()[0] if len(time_diff) > 0 else pd.Timedelta(days=1)
+        SOURCE_STEPS[src] = max(1, round(pd.Timedelta(days=1) / time_step))
+        vprint(f'{src}: {SOURCE_STEPS[src]} time steps per day')
+    return SOURCE_STEPS[src]
 
-    # Group by day and apply appropriate reduction method for each variable
-    daily_data = xr.Dataset()
+# Daily aggregates of each source layout, worked out once per process (see get_daily_reductions)
+DAILY_LAYOUTS = {}
 
-    # Calculate the difference between consecutive time points
-    time_diff = dataset['time'].diff(dim='time')
-    # Convert the differences to a pandas timedelta for easier analysis
-    time_diff_timedelta = time_diff.to_pandas()
-    # Get the most common frequency
-    inferred_frequency = time_diff_timedelta.mode()[0]
+def get_daily_reductions(variables, set_vars, sum_vars, input_vars_repeated, forcing_src, is_daily):
+    '''
+    List the daily aggregates to compute for each variable, following reduceDataByDay
+    The list only depends on the variables of the source and the settings: it is computed once
+    per layout and shared by all the basins
+    Args:
+        variables: list, data variables of the source dataset
+        set_vars: list, variables to be averaged
+        sum_vars: list, variables to be summed
+        input_vars_repeated: list, variables that appear repeatedly
+        forcing_src: str, name of the forcing source (lower case)
+        is_daily: bool, whether the source already has daily frequency
+    Returns:
+        reductions: list, (output name, variable, aggregate) tuples in output order
+    '''
+    layout = (tuple(variables), tuple(set_vars), tuple(sum_vars), tuple(sorted(input_vars_repeated)), forcing_src, is_daily)
+    if layout in DAILY_LAYOUTS:
+        return DAILY_LAYOUTS[layout]
 
-    for variable in dataset.data_vars:
+    reductions = []
+    for variable in variables:
 
         if variable in input_vars_repeated:
             var = f'{variable}_{forcing_src}'
         else:
             var = variable
 
-        # Check if the frequency is daily - daymet
-        if inferred_frequency == pd.Timedelta(days=1) and variable in variable in set_vars:
-            # Do not aggregate and bring to the day dimension: 1980-01-01 12:00:00 to be 1980-01-01
-            daily_data[var] = dataset[variable].assign_coords(time=day_dates)
-        else:
-            if variable in sum_vars:
-                # print('sum', variable)
-                daily_data[var] = dataset[variable].groupby(day_dates).sum(dim="time")
-            elif variable in set_vars:
-                # print('mean', variable)
-                daily_data[var] = dataset[variable].groupby(day_dates).mean(dim="time")
-        
+        # Daily sources are not aggregated: the mean of a single value is the value itself
+        if is_daily and variable in set_vars:
+            reductions.append((var, variable, 'mean'))
+        elif variable in sum_vars:
+            reductions.append((var, variable, 'sum'))
+        elif variable in set_vars:
+            reductions.append((var, variable, 'mean'))
+
         # Add max and min temperature
         if variable == 'tmean':
-            daily_data[f'{var}_max'] = dataset[variable].groupby(day_dates).max(dim="time")
-            daily_data[f'{var}_min'] = dataset[variable].groupby(day_dates).min(dim="time")
+            reductions.append((f'{var}_max', variable, 'max'))
+            reductions.append((f'{var}_min', variable, 'min'))
         elif variable == 't':
-            daily_data[f'{var}_max_{forcing_src}'] = dataset[variable].groupby(day_dates).max(dim="time")
-            daily_data[f'{var}_min_{forcing_src}'] = dataset[variable].groupby(day_dates).min(dim="time")
-
-    # print('daily_data', daily_data)
-    # # Print Data variables
-    # # See if any data_vars are not in set_vars or sum_vars
-    # for var in daily_data.data_vars:
-    #     print(var)
-    #     if var not in set_vars:
-    #         print('Variable not in daily_data:', var)
-    # aux = input('Enter to continue')
-            
+            reductions.append((f'{var}_max_{forcing_src}', variable, 'max'))
+            reductions.append((f'{var}_min_{forcing_src}', variable, 'min'))
+
+    DAILY_LAYOUTS[layout] = reductions
+    return reductions
+
+def strided_daily_stats(times, values, steps_per_day):
+    '''
+    Compute per-day sum, count, max and min of a series sampled at a known stride (e.g. 24 hourly steps per day)
+    No day bins are needed: the full days are reduced with a (days, steps, columns) reshape and the partial
+    days at the edges (e.g. RDRS files starting at 13:00 UTC) on their own
+    Args:
+        times: array-like, datetime64 time stamps of the rows
+        values: numpy.ndarray, array of shape (time, columns)
+        steps_per_day: int, time steps per day of the source
+    Returns:
+        days: pandas.DatetimeIndex, days present in times (None if times are not on the grid of the stride)
+        stats: dict, 'sum', 'count', 'max' and 'min' arrays of shape (days, columns) (None as well)
+    '''
+    stamps = np.asarray(times, dtype='datetime64[ns]').view(np.int64)
+    step = DAY_NS // steps_per_day
+    if DAY_NS % steps_per_day or len(stamps) == 0 or stamps[0] % step or (np.diff(stamps) != step).any():
+        return None, None
+    values = np.asarray(values, dtype=float)
+
+    # Rows of the partial first day, of the full days and of the partial last day
+    head = min((steps_per_day - (stamps[0] % DAY_NS) // step) % steps_per_day, len(stamps))
+    n_full = (len(stamps) - head) // steps_per_day
+    bounds = [0, head, head + n_full * steps_per_day, len(stamps)]
+
+    is_nan = np.isnan(values)
+    filled = np.where(is_nan, 0.0, values)
+    stat_blocks = {'sum': [], 'count': [], 'max': [], 'min': []}
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        if stop == start:
+            continue
+        shape = (max(1, (stop - start) // steps_per_day), -1, values.shape[1])
+        stat_blocks['sum'].append(filled[start:stop].reshape(shape).sum(axis=1))
+        stat_blocks['count'].append((~is_nan[start:stop]).reshape(shape).sum(axis=1))
+        stat_blocks['max'].append(np.fmax.reduce(values[start:stop].reshape(shape), axis=1))
+        stat_blocks['min'].append(np.fmin.reduce(values[start:stop].reshape(shape), axis=1))
+    stats = {stat: np.concatenate(blocks, axis=0) for stat, blocks in stat_blocks.items()}
+
+    # The grid has no gaps: the days follow each other from the day of the first row
+    first_day = stamps[0] - stamps[0] % DAY_NS
+    days = pd.DatetimeIndex((first_day + DAY_NS * np.arange(len(stats['sum']))).astype('datetime64[ns]'))
+    return days, stats
+
+def daily_stats_kernel(times, values, steps_per_day=None):
+    '''
+    Compute per-day sum, count, max and min of a stacked 2-D array in a single pass
+    The day bin index is computed once; regular sampling (same number of steps every day)
+    is reduced with a (days, steps, columns) reshape, irregular sampling with segmented
+    ufunc.reduceat over the day boundaries. NaN values are skipped as in xarray
+    With a known stride of the source the day bins are skipped (see strided_daily_stats)
+    Args:
+        times: array-like, datetime64 time stamps of the rows
+        values: numpy.ndarray, array of shape (time, columns)
+        steps_per_day: int, time steps per day of the source, optional
+    Returns:
+        days: pandas.DatetimeIndex, sorted days present in times
+        stats: dict, 'sum', 'count', 'max' and 'min' arrays of shape (days, columns)
+    '''
+    if steps_per_day is not None and steps_per_day > 1:
+        days, stats = strided_daily_stats(times, values, steps_per_day)
+        if days is not None:
+            return days, stats
+
+    day_dates = np.asarray(pd.to_datetime(times).normalize(), dtype='datetime64[ns]')
+    values = np.asarray(values, dtype=float)
+
+    # Rows of the same day must be contiguous
+    if len(day_dates) > 1 and (np.diff(day_dates) < np.timedelta64(0)).any():
+        order = np.argsort(day_dates, kind='stable')
+        day_dates, values = day_dates[order], values[order]
+
+    # Day bin index: first row of every day
+    starts = np.flatnonzero(np.r_[True, day_dates[1:] != day_dates[:-1]])
+    days = pd.DatetimeIndex(day_dates[starts])
+    steps = np.diff(np.r_[starts, len(day_dates)])
+
+    is_nan = np.isnan(values)
+    filled = np.where(is_nan, 0.0, values)
+
+    if (steps == steps[0]).all():
+        # Regular sampling, e.g. 24 hourly steps per day
+        shape = (len(days), steps[0], values.shape[1])
+        stats = {
+            'sum': filled.reshape(shape).sum(axis=1),
+            'count': (~is_nan).reshape(shape).sum(axis=1),
+            'max': np.fmax.reduce(values.reshape(shape), axis=1),
+            'min': np.fmin.reduce(values.reshape(shape), axis=1),
+        }
+    else:
+        # Irregular sampling (e.g. partial days at the edges of a file)
+        stats = {
+            'sum': np.add.reduceat(filled, starts, axis=0),
+            'count': np.add.reduceat((~is_nan).astype(np.int64), starts, axis=0),
+            'max': np.fmax.reduceat(values, starts, axis=0),
+            'min': np.fmin.reduceat(values, starts, axis=0),
+        }
+    return days, stats
+
+def _partial_daily_stats(dataset, variables, steps_per_day=None):
+    '''
+    Compute per-day sum, count, max and min of the variables of one dataset
+    Args:
+        dataset: xarray.Dataset, hourly (or daily) dataset of a single file
+        variables: list, variables to aggregate
+        steps_per_day: int, time steps per day of the source, optional
+    Returns:
+        days: pandas.DatetimeIndex, days present in the dataset
+        stats: dict, 'sum', 'count', 'max' and 'min' arrays of shape (days, variables * cells)
+    '''
+    n_time = dataset.sizes['time']
+    columns = []
+    for variable in variables:
+        data_array = dataset[variable]
+        if 'time' not in data_array.dims:
+            data_array = data_array.expand_dims(time=dataset['time'])
+        columns.append(data_array.transpose('time', ...).values.reshape(n_time, -1))
+
+    return daily_stats_kernel(dataset.coords['time'].values, np.concatenate(columns, axis=1), steps_per_day)
+
+def reduce_files_by_day(datasets, set_vars, sum_vars, input_vars_repeated, forcing_src, dtype='float64', steps_per_day=None):
+    '''
+    Reduce a sequence of datasets (e.g. monthly files) to daily frequency incrementally
+    Days crossing a file boundary are carried over and completed with the next file,
+    so only one file is held in memory at a time
+    Args:
+        datasets: iterable, time-sorted xarray.Datasets of one data source
+        set_vars: list, variables to be averaged
+        sum_vars: list, variables to be summed
+        input_vars_repeated: list, variables that appear repeatedly
+        forcing_src: str, name of the forcing source (lower case)
+        dtype: str, dtype of the daily values ('float64' or 'float32', always accumulated in float64)
+        steps_per_day: int, time steps per day of the source (see get_source_steps_per_day), detected if None
+    Returns:
+        daily_data: xarray.Dataset, dataset with daily frequency
+    '''
+    reductions = None
+    day_rows, stat_rows = [], {stat: [] for stat in ('sum', 'count', 'max', 'min')}
+    carry_day, carry = None, None
+
+    for dataset in datasets:
+
+        if reductions is None:
+            # Inspect the first file: frequency (unless known), variables and cell layout
+            if steps_per_day is not None:
+                is_daily = steps_per_day == 1
+            else:
+                time_diff = pd.to_datetime(dataset.coords['time'].values).to_series().diff().dropna()
+                is_daily = len(time_diff) > 0 and time_diff.mode()[0] == pd.Timedelta(days=1)
+            reductions = get_daily_reductions(list(dataset.data_vars), set_vars, sum_vars, 
+                                              input_vars_repeated, forcing_src, is_daily)
+            variables = list(dict.fromkeys(variable for _, variable, _ in reductions))
+            if len(variables) == 0:
+                return xr.Dataset()
+            template = dataset[variables[0]].transpose('time', ...)
+            cell_dims = template.dims[1:]
+            cell_shape = template.shape[1:]
+            cell_coords = {dim: dataset.coords[dim] for dim in cell_dims if dim in dataset.coords}
+
+        days, stats = _partial_daily_stats(dataset, variables, steps_per_day)
+
+        # Complete the day carried over from the previous file
+        if carry is not None:
+            if days[0] == carry_day:
+                stats['sum'][0] = stats['sum'][0] + carry['sum']
+                stats['count'][0] = stats['count'][0] + carry['count']
+                stats['max'][0] = np.fmax(stats['max'][0], carry['max'])
+                stats['min'][0] = np.fmin(stats['min'][0], carry['min'])
+            else:
+                day_rows.append([carry_day])
+                for stat in stat_rows:
+                    stat_rows[stat].append(carry[stat][np.newaxis])
+
+        # Keep every day but the last one, which may continue in the next file
+        day_rows.append(days[:-1])
+        for stat in stat_rows:
+            stat_rows[stat].append(stats[stat][:-1])
+        carry_day = days[-1]
+        carry = {stat: stats[stat][-1] for stat in stats}
+        del dataset
+
+    if reductions is None:
+        return xr.Dataset()
+
+    if carry is not None:
+        day_rows.append([carry_day])
+        for stat in stat_rows:
+            stat_rows[stat].append(carry[stat][np.newaxis])
+
+    day_dates = pd.DatetimeIndex(np.concatenate([np.asarray(rows, dtype='datetime64[ns]') for rows in day_rows]))
+    stats = {stat: np.concatenate(rows, axis=0) for stat, rows in stat_rows.items()}
+
+    # Build the daily dataset with the same layout as reduceDataByDay
+    n_cells = int(np.prod(cell_shape))
+    daily_data = xr.Dataset(coords={'time': day_dates, **cell_coords})
+    for var, variable, stat in reductions:
+        i = variables.index(variable) * n_cells
+        if stat == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = stats['sum'][:, i:i + n_cells] / stats['count'][:, i:i + n_cells]
+        else:
+            values = stats[stat][:, i:i + n_cells]
+        daily_data[var] = (('time',) + cell_dims, values.reshape((len(day_dates),) + cell_shape).astype(dtype, copy=False))
+
     return daily_data
 
+def daily_files_to_frame(datasets, set_vars, sum_vars, input_vars_repeated, forcing_src, dtype='float64'):
+    '''
+    Read the files of a daily source (e.g. daymet, one value per day at 12:00) straight into a daily DataFrame
+    Nothing is aggregated: the value arrays are taken as columns and the time stamps only brought to the day
+    (1980-01-01 12:00:00 to 1980-01-01), with the same columns and values as reduce_files_by_day
+    Args:
+        datasets: list, time-sorted in-memory xarray.Datasets of one data source
+        set_vars: list, variables to be averaged
+        sum_vars: list, variables to be summed
+        input_vars_repeated: list, variables that appear repeatedly
+        forcing_src: str, name of the forcing source (lower case)
+        dtype: str, dtype of the daily values ('float64' or 'float32')
+    Returns:
+        daily_df: pandas.DataFrame, daily values with a 'time' column (None if the files are not lumped series
+                  with one value per day, to be reduced by reduce_files_by_day instead)
+    '''
+    if len(datasets) == 0:
+        return None
+    reductions = get_daily_reductions(list(datasets[0].data_vars), set_vars, sum_vars,
+                                      input_vars_repeated, forcing_src, True)
+    variables = list(dict.fromkeys(variable for _, variable, _ in reductions))
+
+    times, columns = [], {variable: [] for variable in variables}
+    for dataset in datasets:
+        times.append(dataset.coords['time'].values)
+        for variable in variables:
+            data_array = dataset[variable]
+            # Lumped series only: a single hru
+            if data_array.dims[0] != 'time' or data_array.size != dataset.sizes['time']:
+                return None
+            columns[variable].append(data_array.values.reshape(-1))
+
+    days = pd.to_datetime(np.concatenate(times)).normalize()
+    if not (days.is_monotonic_increasing and days.is_unique):
+        return None
+
+    daily_columns = {'time': days}
+    for var, variable, stat in reductions:
+        values = np.concatenate(columns[variable]).astype('float64')
+        # Sum of a missing value is 0, as in the daily kernel
+        if stat == 'sum':
+            values = np.where(np.isnan(values), 0.0, values)
+        daily_columns[var] = values.astype(dtype, copy=False)
+    return pd.DataFrame(daily_columns)
+
+def merge_basin_frames_pandas(source_frames, df_target):
+    '''
+    Merge the daily frames of the sources (outer join on 'time') and the target (inner join on 'date')
+    with chained pandas merges (reference for merge_basin_frames)
+    Args:
+        source_frames: list, daily pandas.DataFrames of the sources, with a 'time' column
+        df_target: pandas.DataFrame, target data with a 'time' column
+    Returns:
+        df_merged: pandas.DataFrame, merged basin data with a 'date' column
+    '''
+    df_merged_inp = reduce(lambda left, right: pd.merge(left, right, on='time', how='outer'), source_frames)
+    df_merged_inp = df_merged_inp.rename(columns={'time': 'date'})
+    df_target = df_target.rename(columns={'time': 'date'}).drop_duplicates(subset=['date'])
+    return df_merged_inp.merge(df_target, on='date')
+
+# Column layouts of the merged frames, worked out once per process (see get_merged_layout)
+MERGED_LAYOUTS = {}
+
+def get_merged_layout(source_frames, df_target):
+    '''
+    Work out the column layout of a merged basin frame: column order, position of the columns of each frame
+    in the preallocated array and its dtype. The layout only depends on the columns and dtypes of the frames
+    (the variables of the sources, input_vars_repeated and float_precision), so it is computed once per
+    layout and shared by all the basins
+    Args:
+        source_frames: list, daily pandas.DataFrames of the sources, with a 'time' column
+        df_target: pandas.DataFrame, target data with a 'time' column
+    Returns:
+        layout: dict, 'columns' (merged order, without 'date'), 'frame_columns' and 'slices' of each frame
+                (sources, then the target if 'target_in_block'), 'dtype' of the array; None if the frames
+                need the pandas merge (repeated columns, mixed or non-float dtypes, times that are not dates)
+    '''
+    frames = list(source_frames) + [df_target]
+    key = tuple(tuple((col, df[col].dtype.str) for col in df.columns) for df in frames)
+    if key in MERGED_LAYOUTS:
+        return MERGED_LAYOUTS[key]
+
+    frame_columns = [[col for col in df.columns if col != 'time'] for df in frames]
+    columns = [col for cols in frame_columns for col in cols]
+    source_dtypes = set(df[col].dtype for df, cols in zip(source_frames, frame_columns) for col in cols)
+    layout = None
+    if (len(set(columns)) == len(columns) and len(source_dtypes) == 1 and np.issubdtype(next(iter(source_dtypes)), np.floating)
+            and all(np.issubdtype(df['time'].dtype, np.datetime64) for df in frames)):
+        dtype = source_dtypes.pop()
+        bounds = np.cumsum([0] + [len(cols) for cols in frame_columns])
+        layout = {'columns': columns, 'frame_columns': frame_columns, 
+                  'slices': [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])], 'dtype': dtype,
+                  # Target columns of the same dtype share the array (one block), the others are added as columns
+                  'target_in_block': all(df_target[col].dtype == dtype for col in frame_columns[-1])}
+    MERGED_LAYOUTS[key] = layout
+    return layout
+
+def merge_basin_frames(source_frames, df_target):
+    '''
+    Align the daily frames of the sources and the target on one date index
+    Same rows and values as merge_basin_frames_pandas: the union of the source days (outer join)
+    restricted to the days of the target (inner join, first row of duplicated target days), but always
+    sorted by date (the chained merges append the days missing from the first sources at the end).
+    The columns are placed directly into one array preallocated with the layout of get_merged_layout,
+    without intermediate frames
+    Args:
+        source_frames: list, daily pandas.DataFrames of the sources, with a 'time' column
+        df_target: pandas.DataFrame, target data with a 'time' column
+    Returns:
+        df_merged: pandas.DataFrame, merged basin data with a 'date' column
+    '''
+    layout = get_merged_layout(source_frames, df_target)
+    times = [df['time'].values for df in source_frames] + [df_target['time'].values]
+    # Layout without array, or repeated source days: keep the pandas semantics
+    if layout is None or any(len(np.unique(t)) != len(t) for t in times[:-1]):
+        return merge_basin_frames_pandas(source_frames, df_target)
+
+    # Union of the source days kept by the target, and the first target row of each of them
+    dates = np.unique(np.concatenate(times[:-1]))
+    target_times, target_rows = np.unique(times[-1], return_index=True)
+    dates = dates[np.isin(dates, target_times)]
+    target_rows = target_rows[np.searchsorted(target_times, dates)]
+
+    target_cols = layout['frame_columns'][-1]
+    n_block = len(layout['columns']) - (0 if layout['target_in_block'] else len(target_cols))
+    values = np.full((len(dates), n_block), np.nan, dtype=layout['dtype'])
+    for df, cols, (start, stop) in zip(source_frames, layout['frame_columns'], layout['slices']):
+        # Rows of the source that fall on the kept days, and their position in the merged array
+        pos = np.searchsorted(dates, df['time'].values)
+        found = pos < len(dates)
+        found[found] = dates[pos[found]] == df['time'].values[found]
+        values[pos[found], start:stop] = df[cols].values[found]
+    if layout['target_in_block'] and target_cols:
+        start, stop = layout['slices'][-1]
+        values[:, start:stop] = df_target[target_cols].values[target_rows]
+
+    df_merged = pd.DataFrame(values, columns=layout['columns'][:n_block], copy=False)
+    df_merged.insert(0, 'date', dates)
+    if not layout['target_in_block']:
+        for col in target_cols:
+            df_merged[col] = df_target[col].values[target_rows]
+    return df_merged
+
 def load_util_data(root_dir):
     '''
     Load data from data_dir.yml and data_general.yml
@@ -99,44 +526,37 @@ def get_unusable_basins(input_files_dir, unusable_file):
         input_files_dir: str, path to input files directory
         unusable_file: str, name of unusable basins file
     Returns:
-        unusuable_basins: list, list of unusable basins
+        unusuable_basins: set, station ids of the unusable basins
     '''
-    # Load csv
-    unusuable_basins_df = pd.read_csv(os.path.join(input_files_dir, unusable_file))
-    # # Country + '_' Station_id
-    # unusuable_basins = ['_'.join((row['Country'], str(row['Station_id']))) for _, row in unusuable_basins_df.iterrows()]
+    # Load csv (station ids as strings, to keep the leading zeros)
+    unusuable_basins_df = pd.read_csv(os.path.join(input_files_dir, unusable_file), dtype={'Station_id': str})
 
     # Filter by 'No discharge values available ...' in Reason column
-    unusuable_basins_df = unusuable_basins_df[unusuable_basins_df['Reason'].str.contains('No discharge values available', case=False)]
+    is_unusable = unusuable_basins_df['Reason'].str.contains('No discharge values available', case=False, na=False)
 
     # Station_id
-    unusuable_basins = [str(row['Station_id']) for _, row in unusuable_basins_df.iterrows()]
-    
-    return set(unusuable_basins)
+    return set(unusuable_basins_df.loc[is_unusable, 'Station_id'])
 
 # Function to calculate statistics for time frames
 def calculate_time_stats(country_dir):
     '''
     Calculate start dates, end dates, and total time lengths for each basin
+    The dates come from the basin summaries written during the conversion (see utils.stats),
+    or from the date column of the outputs without summary, read in parallel and then cached
     Args:
         country_dir: str, path to country directory
     Returns:
+        basin_ids: list, basin ids
         start_dates: list, start dates for each basin
         end_dates: list, end dates for each basin
         total_time_lengths: list, total time lengths for each basin
     '''
-    files = os.listdir(country_dir)
-    basin_ids = []
-    start_dates = []
-    end_dates = []
-    total_time_lengths = []
-    for file in files:
-        basin_ids.append(file.split('_')[-1].split('.')[0])
-        df = pd.read_csv(os.path.join(country_dir, file))
-        df['date'] = pd.to_datetime(df['date'])  # Convert 'date' column to datetime
-        start_dates.append(df['date'].min())
-        end_dates.append(df['date'].max())
-        total_time_lengths.append(round((df['date'].max() - df['date'].min()).days / 365, 1))  # Calculate total length in years and round to 1 decimal place
+    summaries = get_country_summaries(country_dir)
+    basin_ids = list(summaries)
+    start_dates = list(pd.to_datetime([summaries[basin_id]['start'] for basin_id in basin_ids]))
+    end_dates = list(pd.to_datetime([summaries[basin_id]['end'] for basin_id in basin_ids]))
+    # Calculate total length in years and round to 1 decimal place
+    total_time_lengths = [round((end_date - start_date).days / 365, 1) for start_date, end_date in zip(start_dates, end_dates)]
 
     return basin_ids, start_dates, end_dates, total_time_lengths
 
@@ -0,0 +1,201 @@
+import os
+import threading
+import concurrent.futures
+import numpy as np
+import xarray as xr
+import pandas as pd
+
+
+# File extension of each output format
+OUTPUT_EXTENSIONS = {
+    'csv': '.csv',
+    'parquet': '.parquet',
+    'feather': '.feather',
+    'netcdf': '.nc',
+}
+
+def get_basin_output_path(country_dir, basin_id, output_format='csv'):
+    '''
+    Get the output file path of a basin
+    Args:
+        country_dir: str, output folder of the basin's country
+        basin_id: str, basin id (e.g. '01013500')
+        output_format: str, one of OUTPUT_EXTENSIONS
+    Returns:
+        file_path: str, path to the basin output file
+    '''
+    if output_format not in OUTPUT_EXTENSIONS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {list(OUTPUT_EXTENSIONS)}")
+    return os.path.join(country_dir, basin_id + OUTPUT_EXTENSIONS[output_format])
+
+def to_typed_frame(df):
+    '''
+    Cast a basin DataFrame to compact types: datetime64 'date' and float32 values
+    Args:
+        df: pandas.DataFrame, basin data with a 'date' column
+    Returns:
+        df: pandas.DataFrame, typed copy of the basin data
+    '''
+    float_cols = [col for col in df.columns if col != 'date' and np.issubdtype(df[col].dtype, np.number)]
+    df = df.astype({col: np.float32 for col in float_cols})
+    df['date'] = pd.to_datetime(df['date'])
+    return df.reset_index(drop=True)
+
+def write_basin_csv(df, file_path):
+    '''
+    Write a basin DataFrame to csv (full float precision, as in previous versions)
+    Args:
+        df: pandas.DataFrame, basin data with a 'date' column
+        file_path: str, path to the output file
+    '''
+    df.to_csv(file_path, index=False)
+
+def write_basin_parquet(df, file_path):
+    '''
+    Write a basin DataFrame to parquet with typed columns (requires pyarrow)
+    Args:
+        df: pandas.DataFrame, basin data with a 'date' column
+        file_path: str, path to the output file
+    '''
+    to_typed_frame(df).to_parquet(file_path, index=False)
+
+def write_basin_feather(df, file_path):
+    '''
+    Write a basin DataFrame to feather with typed columns (requires pyarrow)
+    Args:
+        df: pandas.DataFrame, basin data with a 'date' column
+        file_path: str, path to the output file
+    '''
+    to_typed_frame(df).to_feather(file_path)
+
+def write_basin_netcdf(df, file_path):
+    '''
+    Write a basin DataFrame to netCDF with a 'date' dimension, as read by NeuralHydrology
+    Args:
+        df: pandas.DataFrame, basin data with a 'date' column
+        file_path: str, path to the output file
+    '''
+    to_typed_frame(df).set_index('date').to_xarray().to_netcdf(file_path)
+
+# Writer of each output format
+BASIN_WRITERS = {
+    'csv': write_basin_csv,
+    'parquet': write_basin_parquet,
+    'feather': write_basin_feather,
+    'netcdf': write_basin_netcdf,
+}
+
+def write_basin(df, file_path, output_format='csv'):
+    '''
+    Write a basin DataFrame with the writer of the given output format, atomically
+    Args:
+        df: pandas.DataFrame, basin data with a 'date' column
+        file_path: str, path to the output file
+        output_format: str, one of BASIN_WRITERS
+    '''
+    if output_format not in BASIN_WRITERS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {list(BASIN_WRITERS)}")
+    # Written to a temporary file and renamed, so that a killed run never leaves a partial output file
+    tmp_path = file_path + '.tmp'
+    try:
+        BASIN_WRITERS[output_format](df, tmp_path)
+        os.replace(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# Write-behind queue of the process: writer threads, and bytes of the frames queued or being written
+WRITE_QUEUE = {'executor': None, 'max_bytes': 0, 'queued_bytes': 0, 'condition': threading.Condition()}
+
+def start_write_queue(writer_threads=1, max_queued_mb=256):
+    '''
+    Start the writer threads of the process, which write the basins handed off by queue_write
+    while the next basins are converted
+    Args:
+        writer_threads: int, number of writer threads (0: basins are written by queue_write itself)
+        max_queued_mb: float, memory of the frames held by the queue above which queue_write waits
+    '''
+    close_write_queue()
+    if writer_threads > 0:
+        WRITE_QUEUE['executor'] = concurrent.futures.ThreadPoolExecutor(max_workers=writer_threads, 
+                                                                        thread_name_prefix='basin_writer')
+        WRITE_QUEUE['max_bytes'] = int(max_queued_mb * 2**20)
+
+def close_write_queue():
+    '''
+    Wait for the queued basins to be written and stop the writer threads of the process
+    '''
+    executor, WRITE_QUEUE['executor'] = WRITE_QUEUE['executor'], None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+def queue_write(write, df, on_done, *args):
+    '''
+    Hand off a basin frame to the writer threads (written now if the queue is not started)
+    Waits while the queued frames take more than max_queued_mb, so that a slow file system holds back the
+    conversion instead of filling the memory (a frame is always accepted by an empty queue)
+    Args:
+        write: callable, write function, called as write(df, *args)
+        df: pandas.DataFrame, basin frame (not modified once queued)
+        on_done: callable, called with None once written or with the exception raised by write
+        args: other arguments of write
+    '''
+    executor = WRITE_QUEUE['executor']
+    if executor is None:
+        try:
+            write(df, *args)
+        except Exception as e:
+            on_done(e)
+            return
+        on_done(None)
+        return
+
+    n_bytes = int(df.memory_usage(deep=True).sum())
+    condition = WRITE_QUEUE['condition']
+    with condition:
+        condition.wait_for(lambda: WRITE_QUEUE['queued_bytes'] == 0 or 
+                                   WRITE_QUEUE['queued_bytes'] + n_bytes <= WRITE_QUEUE['max_bytes'])
+        WRITE_QUEUE['queued_bytes'] += n_bytes
+
+    def write_behind():
+        error = None
+        try:
+            write(df, *args)
+        except Exception as e:
+            error = e
+        finally:
+            with condition:
+                WRITE_QUEUE['queued_bytes'] -= n_bytes
+                condition.notify_all()
+        on_done(error)
+
+    executor.submit(write_behind)
+
+def read_basin(file_path, output_format='csv', columns=None):
+    '''
+    Read a basin output file back into a DataFrame
+    Args:
+        file_path: str, path to the basin output file
+        output_format: str, one of BASIN_WRITERS
+        columns: list, columns to read (all if None); 'date' is always included
+    Returns:
+        df: pandas.DataFrame, basin data with a datetime64 'date' column
+    '''
+    if columns is not None:
+        columns = ['date'] + [col for col in columns if col != 'date']
+
+    if output_format == 'csv':
+        df = pd.read_csv(file_path, usecols=columns, parse_dates=['date'])
+    elif output_format == 'parquet':
+        df = pd.read_parquet(file_path, columns=columns)
+    elif output_format == 'feather':
+        df = pd.read_feather(file_path, columns=columns)
+    elif output_format == 'netcdf':
+        with xr.open_dataset(file_path) as ds:
+            if columns is not None:
+                ds = ds[columns[1:]]
+            df = ds.to_dataframe().reset_index()
+    else:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {list(BASIN_WRITERS)}")
+
+    return df if columns is None else df[columns]